@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Compare the throughput of test.checksums against the old 100 KB-block md5sum.
+
+    python scripts/benchmark_checksums.py --size-mb 1024 --files 4
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+
+pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noqa
+sys.path.insert(0, pkg_root)  # noqa
+
+from test.checksums import checksum, checksum_files, google_crc32c
+
+
+def legacy_md5sum(file_name):
+    # what test.utils.md5sum used to do (minus the invalid `size=` keyword)
+    hash = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(100000), b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark local checksumming.')
+    parser.add_argument('--size-mb', type=int, default=256, help='Size of each generated test file.')
+    parser.add_argument('--files', type=int, default=4, help='Number of files for the concurrent run.')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    algorithms = ('md5', 'crc32c') if google_crc32c is not None else ('md5',)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(tmp, f'{i}.bin')
+            with open(path, 'wb') as f:
+                for _ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            paths.append(path)
+        mb = args.size_mb
+
+        legacy, seconds = timed(legacy_md5sum, paths[0])
+        results['legacy_md5sum'] = mb / seconds
+        for name, kwargs in (('readinto_md5', dict(algorithms=('md5',))),
+                             ('mmap_md5', dict(algorithms=('md5',), use_mmap=True)),
+                             ('readinto_all', dict(algorithms=algorithms))):
+            result, seconds = timed(checksum, paths[0], **kwargs)
+            assert result.md5 == legacy, f'{name} md5 mismatch'
+            results[name] = mb / seconds
+
+        _, seconds = timed(lambda: [legacy_md5sum(p) for p in paths])
+        results['legacy_md5sum_serial_all_files'] = mb * len(paths) / seconds
+        _, seconds = timed(lambda: list(checksum_files(paths, workers=args.workers, algorithms=algorithms)))
+        results['checksum_files_concurrent'] = mb * len(paths) / seconds
+
+    print(json.dumps({'file_size_mb': args.size_mb,
+                      'files': args.files,
+                      'algorithms': algorithms,
+                      'mb_per_s': {name: round(rate, 1) for name, rate in results.items()}}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
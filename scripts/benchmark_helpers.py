@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Benchmark the integration-test helpers against the local stub services (test/stub_server.py).
+
+Each helper is called `--requests` times at every `--concurrency` level, and the requests/sec, latency
+percentiles, client CPU time per call and change in resident memory are printed (or written with `--output`)
+as JSON:
+
+    python scripts/benchmark_helpers.py --concurrency 1,4,16 --output before.json
+    ... change something ...
+    python scripts/benchmark_helpers.py --concurrency 1,4,16 --compare before.json
+
+With `--compare`, any helper/concurrency whose throughput dropped or p95 latency rose by more than
+`--tolerance` is listed, and the script exits non-zero.
+
+The stub runs in a subprocess (`test.stub_server.spawn`) so that its CPU time isn't counted against the client.
+Circuit breakers are turned off, so that with `--error-rate` the helpers' retries are measured rather than
+calls failed fast on the client.
+
+Every run reports `rss_delta_mb`, how much the resident set grew (or shrank) over the run.  With
+`--trace-memory`, how far each run raised the Python memory in use above where it started is also measured
+with `tracemalloc` (whose peak is reset before every run) and reported as `peak_traced_mb`.  Tracing slows
+allocation down, so compare throughput and CPU only between runs that both did or both didn't trace memory.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import resource
+import tracemalloc
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noqa
+sys.path.insert(0, pkg_root)  # noqa
+
+from test.retry import enable_circuit_breakers
+from test.stub_server import spawn
+from test.terra.submissions import percentile
+
+HELPERS = ('import_drs_from_gen3', 'check_workflow_status', 'pfb_job_status_in_terra',
+           'SevenBridgesBrokerClient.request', 'bq.Client.add_row')
+
+
+def rss_mb() -> float:
+    """The current resident set size, or the peak so far where the current one can't be read (e.g. macOS)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except (OSError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024  # bytes on macOS, KiB on Linux
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def build_helpers(stub_url: str) -> Dict[str, Callable[[int], object]]:
+    """Setup done once per helper, returning functions that make the `i`th call."""
+    # imported here so that test.utils reads the local stage config set up in main()
+    from test import auth, utils
+    from test.seven_bridges.sb_broker import SBEnv, SevenBridgesBrokerClient
+
+    auth.terra_token_cache = auth.TokenCache(lambda: 'benchmark-token')
+
+    guids = [f'drs://dg.STUB/{uuid.uuid4()}' for _ in range(100)]
+    submission_id = utils.run_workflow()['submissionId']
+    utils.create_terra_workspace('benchmark')
+    pfb_job = utils.import_pfb('benchmark', 'https://example.com/benchmark.avro')['jobId']
+    broker = SevenBridgesBrokerClient(token='benchmark-token', base_url=stub_url)
+    task = broker.new_test_run(list(SBEnv)[0], 'benchmark')
+
+    helpers = {
+        'import_drs_from_gen3': lambda i: utils.import_drs_from_gen3(guids[i % len(guids)]),
+        'check_workflow_status': lambda i: utils.check_workflow_status(submission_id),
+        'pfb_job_status_in_terra': lambda i: utils.pfb_job_status_in_terra('benchmark', pfb_job),
+        'SevenBridgesBrokerClient.request': lambda i: broker.request('GET', f'/tasks/{task["id"]}'),
+    }
+    try:
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import bigquery
+        from test.bq import Client
+    except ImportError:
+        pass  # google-cloud-bigquery isn't installed; reported as skipped
+    else:
+        bq_client = Client(client=bigquery.Client(project='benchmark', credentials=AnonymousCredentials(),
+                                                  client_options={'api_endpoint': stub_url}))
+        helpers['bq.Client.add_row'] = lambda i: bq_client.add_row('benchmark.bdc.benchmark', {'t': str(i), 'd': i})
+    return helpers
+
+
+def run_level(call: Callable[[int], object], concurrency: int, requests: int) -> dict:
+    latencies: List[float] = []
+    errors = 0
+
+    def one(i: int):
+        start = time.perf_counter()
+        try:
+            call(i)
+        except Exception:
+            return None
+        return time.perf_counter() - start
+
+    traced_start = 0
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        traced_start = tracemalloc.get_traced_memory()[0]
+    rss_start = rss_mb()
+    cpu_start, wall_start = cpu_seconds(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency in executor.map(one, range(requests)):
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+    wall, cpu = time.perf_counter() - wall_start, cpu_seconds() - cpu_start
+    rss_delta = rss_mb() - rss_start
+    # ru_maxrss is the peak of the whole process so far, so it can't be attributed to one run; the traced peak can
+    peak_traced_mb = None
+    if tracemalloc.is_tracing():
+        peak_traced_mb = round((tracemalloc.get_traced_memory()[1] - traced_start) / (1024 * 1024), 2)
+
+    def ms(seconds: Optional[float]) -> Optional[float]:
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {'concurrency': concurrency,
+            'requests': requests,
+            'errors': errors,
+            'requests_per_s': round(requests / wall, 1),
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p95_ms': ms(percentile(latencies, 95)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'cpu_ms_per_call': round(cpu / requests * 1000, 3),
+            'rss_delta_mb': round(rss_delta, 2),
+            'peak_traced_mb': peak_traced_mb}
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """Human-readable regressions of `current` against `baseline`."""
+    regressions = []
+    for helper, levels in current['results'].items():
+        before = {level['concurrency']: level for level in baseline.get('results', {}).get(helper, [])}
+        for level in levels:
+            old = before.get(level['concurrency'])
+            if old is None:
+                continue
+            name = f'{helper} @ concurrency {level["concurrency"]}'
+            if level['requests_per_s'] < old['requests_per_s'] * (1 - tolerance):
+                regressions.append(f'{name}: {old["requests_per_s"]} -> {level["requests_per_s"]} requests/s')
+            if old['p95_ms'] and level['p95_ms'] and level['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+                regressions.append(f'{name}: p95 {old["p95_ms"]} -> {level["p95_ms"]} ms')
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=pkg_root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark the test helpers against the local stub services.')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='Comma-separated concurrency levels.')
+    parser.add_argument('--requests', type=int, default=500, help='Calls per helper per concurrency level.')
+    parser.add_argument('--helpers', default=','.join(HELPERS), help='Comma-separated helpers to benchmark.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added by the stub.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of stub responses that are 503s.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Measure the peak memory allocated during each run (slows the helpers down).')
+    parser.add_argument('--output', help='Write the JSON results here as well as to stdout.')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression (0.2 = 20%%).')
+    args = parser.parse_args(argv)
+
+    stub, stub_url = spawn(latency=args.latency, error_rate=args.error_rate)
+    enable_circuit_breakers(False)
+    if args.trace_memory:
+        tracemalloc.start()
+    os.environ['BDCAT_STAGE'] = 'local'
+    os.environ['BDCAT_STUB_URL'] = stub_url
+    try:
+        helpers = build_helpers(stub_url)
+        results, skipped = {}, []
+        for name in args.helpers.split(','):
+            if name not in helpers:
+                print(f'Skipping {name}: not available here.', file=sys.stderr)
+                skipped.append(name)
+                continue
+            helpers[name](0)  # warm up connections and caches
+            results[name] = [run_level(helpers[name], int(concurrency), args.requests)
+                             for concurrency in args.concurrency.split(',')]
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    output = {'commit': git_commit(),
+              'python': platform.python_version(),
+              'cpus': os.cpu_count(),
+              'stub': {'latency': args.latency, 'error_rate': args.error_rate},
+              'trace_memory': args.trace_memory,
+              'results': results,
+              'skipped': skipped}
+    print(json.dumps(output, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('trace_memory', False) != args.trace_memory:
+            print('WARNING Only one of the runs traced memory, which skews throughput and CPU time.', file=sys.stderr)
+        regressions = compare(baseline, output, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
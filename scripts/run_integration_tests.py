@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import requests
-import time
 import os
 import sys
 import argparse
@@ -8,6 +7,8 @@ import argparse
 pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noqa
 sys.path.insert(0, pkg_root)  # noqa
 
+from test import polling, sessions
+from test.metrics import log_metrics
 from test.utils import retry
 
 PRIVATE_TOKEN = os.environ['GITLAB_READ_TOKEN']
@@ -20,49 +21,67 @@ DEFAULT_PROJECT_NUM = 3
 @retry(error_codes={500, 502, 503, 504}, errors={requests.exceptions.HTTPError, ConnectionError})
 def get_status(pipeline, host=DEFAULT_HOST, project=DEFAULT_PROJECT_NUM):
     job_status_url = f'{host}/api/v4/projects/{project}/pipelines/{pipeline}'
-    response = requests.get(job_status_url, headers={'PRIVATE-TOKEN': PRIVATE_TOKEN})
+    response = sessions.get(job_status_url, headers={'PRIVATE-TOKEN': PRIVATE_TOKEN})
     response.raise_for_status()
     return response.json()['status']
 
 
-def wait_for_final_status(pipeline, host=DEFAULT_HOST, project=DEFAULT_PROJECT_NUM, quiet=False):
-    status = 'pending'
-    while status in ('pending', 'running'):
-        time.sleep(10)
-        status = get_status(pipeline=pipeline, host=host, project=project)
+def poll_final_status(pipeline, host=DEFAULT_HOST, project=DEFAULT_PROJECT_NUM, quiet=False):
+    """A `polling.poll` coroutine that returns the pipeline's status once it's no longer pending or running."""
+    def print_status(status):
         if not quiet:
-            print(f'Status is: {status}')
-            print('Checking status again in 10 seconds.')
-    return status
+            print(f'Status of pipeline {pipeline} is: {status}')
+
+    return polling.poll(lambda: get_status(pipeline=pipeline, host=host, project=project),
+                        done=lambda status: status not in ('pending', 'running'),
+                        interval=10,
+                        max_interval=60,
+                        state=lambda status: status,
+                        on_result=print_status)
+
+
+def wait_for_final_status(pipeline, host=DEFAULT_HOST, project=DEFAULT_PROJECT_NUM, quiet=False):
+    return polling.wait_for_all(poll_final_status(pipeline, host=host, project=project, quiet=quiet))[0]
+
+
+def trigger_pipeline(branch, host=DEFAULT_HOST, project=DEFAULT_PROJECT_NUM):
+    """Start the integration tests on `branch` and return the pipeline's web URL."""
+    job_trigger_url = f'{host}/api/v4/projects/{project}/trigger/pipeline?token={TOKEN}&ref={branch}'
+    response = sessions.post(job_trigger_url)
+    response.raise_for_status()
+    return response.json()['web_url']
 
 
 def main(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Gitlab Test Trigger')
     parser.add_argument("--project", type=int, default=DEFAULT_PROJECT_NUM)
-    parser.add_argument("--branch", default=DEFAULT_BRANCH)
+    parser.add_argument("--branch", default=DEFAULT_BRANCH,
+                        help='Branch to run the tests on, or a comma-separated list of branches to run them on at once.')
     parser.add_argument("--host", default=DEFAULT_HOST)
     parser.add_argument("--quiet", default=False, help='Suppress printing run messages.')
     args = parser.parse_args(argv)
 
-    job_trigger_url = f'{args.host}/api/v4/projects/{args.project}/trigger/pipeline?token={TOKEN}&ref={args.branch}'
-
-    response = requests.post(job_trigger_url)
-    response.raise_for_status()
-    test_url = response.json()['web_url']
-    pipeline = test_url.split('/')[-1].strip()
+    test_urls = [trigger_pipeline(branch, host=args.host, project=args.project) for branch in args.branch.split(',')]
+    pipelines = [test_url.split('/')[-1].strip() for test_url in test_urls]
 
     if not args.quiet:
-        print('Starting integration tests.  Checking status in 10 seconds.')
-        print(f'See: {test_url}')
+        print('Starting integration tests.')
+        for test_url in test_urls:
+            print(f'See: {test_url}')
 
-    status = wait_for_final_status(pipeline=pipeline, host=args.host, project=args.project, quiet=args.quiet)
+    # the pipelines run independently, so wait for all of them in one event loop rather than one after another
+    statuses = polling.wait_for_all(*(poll_final_status(pipeline, host=args.host, project=args.project, quiet=args.quiet)
+                                      for pipeline in pipelines))
+    log_metrics()
 
-    if status == 'failed':
-        raise RuntimeError('Integration Tests have Failed: ' + test_url)
+    failed = [test_url for test_url, status in zip(test_urls, statuses) if status == 'failed']
+    if failed:
+        raise RuntimeError('Integration Tests have Failed: ' + ', '.join(failed))
 
     if not args.quiet:
-        print(f'Exiting.  Status was: {status}')
-        print(f'See: {test_url}')
+        for test_url, status in zip(test_urls, statuses):
+            print(f'Exiting.  Status was: {status}')
+            print(f'See: {test_url}')
 
 
 if __name__ == '__main__':
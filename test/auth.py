@@ -0,0 +1,173 @@
+"""
+Cached bearer tokens for the Terra (Google) and Gen3 APIs.
+
+`gs.get_access_token()` refreshes Google credentials on every call, so calling it once per request turns a
+long status-polling loop into hundreds of token round trips.  Google access tokens are good for an hour, so
+we cache the token and only fetch a new one shortly before it expires.
+
+Likewise, a Gen3 API key is exchanged for an access token once and that token is reused until its `exp` claim.
+"""
+import os
+import time
+import base64
+import logging
+import threading
+
+import jwt
+
+from typing import Callable, Dict, Optional, Tuple
+
+from terra_notebook_utils import gs
+
+from test import sessions
+
+log = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    Thread-safe cache around a function that fetches a bearer token.
+
+    Once a token is within `refresh_margin` seconds of expiring, the first caller to notice fetches a new
+    one while everyone else keeps using the still-valid current token.  Once it has expired, callers block
+    and concurrent refreshes are coalesced into a single fetch.
+
+    :param fetch: Returns a new access token.
+    :param lifetime: How long (in seconds) a freshly fetched token is valid.
+    :param refresh_margin: How long (in seconds) before expiry to start fetching a replacement.
+    """
+    def __init__(self, fetch: Callable[[], str], lifetime: float = 3600, refresh_margin: float = 300):
+        if refresh_margin >= lifetime:
+            raise ValueError(f'refresh_margin ({refresh_margin}) must be less than lifetime ({lifetime}).')
+        self._fetch = fetch
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def _count(self, stat: str):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def _fresh(self, now: float) -> bool:
+        return self._token is not None and now < self._expires_at - self.refresh_margin
+
+    def _refresh(self):
+        fetched_at = time.monotonic()
+        token = self._fetch()
+        self._token, self._expires_at = token, fetched_at + self.lifetime
+        self._count('refreshes')
+
+    def get(self) -> str:
+        now = time.monotonic()
+        if self._fresh(now):
+            self._count('hits')
+            return self._token
+        token = self._token
+        if token is not None and now < self._expires_at:
+            # about to expire: one caller refreshes early, the rest keep using the current token
+            if self._lock.acquire(blocking=False):
+                try:
+                    if not self._fresh(time.monotonic()):
+                        self._refresh()
+                finally:
+                    self._lock.release()
+            self._count('hits')
+            return self._token
+        with self._lock:
+            if self._fresh(time.monotonic()):
+                # another thread refreshed while we were waiting
+                self._count('hits')
+            else:
+                self._count('misses')
+                self._refresh()
+            return self._token
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after a 401, so that the next call fetches a new one."""
+        with self._lock:
+            self._token, self._expires_at = None, 0.0
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+terra_token_cache = TokenCache(gs.get_access_token)
+
+
+def get_access_token() -> str:
+    """A cached replacement for `gs.get_access_token()`."""
+    return terra_token_cache.get()
+
+
+class Gen3Credentials:
+    """
+    Exchanges a Gen3 API key for access tokens, caching one token per issuer until its `exp` claim.
+
+    The API key is base64-decoded and JWT-decoded once, on first use.
+
+    :param encoded_api_key: The base64-encoded API key.  Defaults to the GEN3_API_KEY environment variable.
+    :param refresh_margin: How long (in seconds) before `exp` to stop handing out a token.
+    """
+    def __init__(self, encoded_api_key: Optional[str] = None, refresh_margin: float = 60):
+        self._encoded_api_key = encoded_api_key
+        self.refresh_margin = refresh_margin
+        self._api_key: Optional[str] = None
+        self._issuer: Optional[str] = None
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def _decode_api_key(self):
+        if self._api_key is None:
+            encoded = self._encoded_api_key or os.environ['GEN3_API_KEY']
+            api_key = base64.decodebytes(encoded.encode('utf-8')).decode('utf-8')
+            self._issuer = jwt.decode(api_key, verify=False)['iss']
+            self._api_key = api_key
+
+    @property
+    def hostname(self) -> str:
+        """The Gen3 commons that issued the API key, e.g. https://staging.gen3.biodatacatalyst.nhlbi.nih.gov"""
+        with self._lock:
+            self._decode_api_key()
+        return self._issuer.replace('/user', '')
+
+    def get_access_token(self) -> str:
+        with self._lock:
+            self._decode_api_key()
+            token, expires_at = self._tokens.get(self._issuer, (None, 0.0))
+            if token is not None and time.time() < expires_at - self.refresh_margin:
+                self._stats['hits'] += 1
+                return token
+            self._stats['misses'] += 1
+            hostname = self._issuer.replace('/user', '')
+            response = sessions.post(f'{hostname}/user/credentials/api/access_token',
+                                     data={"api_key": self._api_key, "Content-Type": "application/json"})
+            response.raise_for_status()
+            token = response.json()['access_token']
+            self._tokens[self._issuer] = (token, float(jwt.decode(token, verify=False)['exp']))
+            self._stats['refreshes'] += 1
+            return token
+
+    def invalidate(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+
+gen3_credentials = Gen3Credentials()
+
+
+def log_token_stats():
+    for name, cache in (('Terra', terra_token_cache), ('Gen3', gen3_credentials)):
+        stats = cache.stats()
+        if any(stats.values()):
+            log.info('%s access token: %d cache hits, %d misses, %d fetches',
+                     name, stats['hits'], stats['misses'], stats['refreshes'])
@@ -19,20 +19,24 @@ import base64
 pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noqa
 sys.path.insert(0, pkg_root)  # noqa
 
-from test.bq import log_duration, Client
+from test import auth, sessions
+from test.bq import log_duration, Client, drain, get_client
 from test.infra.testmode import staging_only
+from test.metrics import log_metrics
+from test.parallel import ParallelTestRunner
+from test.retry import log_retry_stats
 from test.utils import (run_workflow,
                         create_terra_workspace,
                         delete_terra_workspace,
                         pfb_job_status_in_terra,
                         import_pfb,
                         retry,
-                        check_terra_health,
                         import_dockstore_wf_into_terra,
                         check_workflow_presence_in_terra_workspace,
                         delete_workflow_presence_in_terra_workspace,
                         check_workflow_status,
                         import_drs_with_direct_gen3_access_token,
+                        preflight,
                         BILLING_PROJECT,
                         STAGE)
 
@@ -54,7 +58,7 @@ class TestGen3DataAccess(unittest.TestCase):
             os.makedirs(gcloud_cred_dir, exist_ok=True)
         with open(os.path.expanduser('~/.config/gcloud/application_default_credentials.json'), 'w') as f:
             f.write(base64.decodebytes(os.environ['TEST_MULE_CREDS'].encode('utf-8')).decode('utf-8'))
-        print(f'Terra [{STAGE}] Health Status:\n\n{json.dumps(check_terra_health(), indent=4)}')
+        print(f'Preflight [{STAGE}]:\n{preflight.report()}')
 
     @classmethod
     def tearDownClass(cls) -> None:
@@ -117,6 +121,7 @@ class TestGen3DataAccess(unittest.TestCase):
                 timeout -= 2
 
     @staging_only
+    @preflight.requires('gen3')
     def test_import_drs_from_gen3(self):
         # TODO: This commented out section SHOULD be how we check for the ACL and DRS files we don't
         #  have access to, but this is giving problems, so have to hardcode known restricted files.
@@ -127,15 +132,16 @@ class TestGen3DataAccess(unittest.TestCase):
         #                'drs://dg.712C/2d9692bb-2050-4742-b7ae-42a83de6129e',
         #                'drs://dg.712C/39474412-fc6d-4dbc-81c2-176db2403130']
         #
-        # response = requests.get(
-        #     'https://staging.gen3.biodatacatalyst.nhlbi.nih.gov/index/index?'
-        #     'negate_params={"acl":["*","admin","topmed",'
-        #     '"phs000888", "phs000681", "phs001014", "phs001095", "phs001215", '
-        #     '"phs001544", "phs001395", "phs000169", "phs000636", "phs000820", '
-        #     '"phs000971", "phs000984", "phs000292", "phs000997", "phs000944", '
-        #     '"phs000304", "phs000209", "phs000538", "phs000353"]}')
-        # restricted_records = [r['did'] for r in response.json()['records'] if r['did'] not in public_uris]
-        # drs_uri = random.choice(restricted_records)
+        # index = LocalIndex()  # from test.indexd
+        # index.refresh()
+        # restricted_records = index.sample(
+        #     acl_not_in={"*", "admin", "topmed",
+        #                 "phs000888", "phs000681", "phs001014", "phs001095", "phs001215",
+        #                 "phs001544", "phs001395", "phs000169", "phs000636", "phs000820",
+        #                 "phs000971", "phs000984", "phs000292", "phs000997", "phs000944",
+        #                 "phs000304", "phs000209", "phs000538", "phs000353"},
+        #     limit=10)
+        # drs_uri = random.choice([r.drs_uri for r in restricted_records if r.drs_uri not in public_uris])
 
         # first try to download the file and we should be denied
         # only downloads the first byte even if successful to keep it short
@@ -188,7 +194,7 @@ class SaveResult(TextTestResult):
         self.tests_run[test] = 'success'
 
 
-class SaveResultRunner(TextTestRunner):
+class SaveResultRunner(ParallelTestRunner):
     resultclass = SaveResult
 
 
@@ -196,7 +202,7 @@ if __name__ == "__main__":
     test_run = unittest.main(verbosity=2, exit=False, testRunner=SaveResultRunner)
     results: SaveResult = test_run.result
     timestamp = datetime.datetime.now()
-    client = Client()
+    client = get_client()
     for test, status in results.tests_run.items():
         # Unfortunately this is the only way to get the test method name from the TestCase
         test_name = test._testMethodName
@@ -205,4 +211,9 @@ if __name__ == "__main__":
             client.log_test_results(test_name, status, timestamp, create=True)
         except Exception as e:
             logger.exception('Failed to log test %r', test, exc_info=e)
+    drain()
+    sessions.log_connection_stats()
+    auth.log_token_stats()
+    log_retry_stats()
+    log_metrics()
     sys.exit(not results.wasSuccessful())
@@ -1,28 +1,188 @@
+"""
+Logging test results and timings to BigQuery.
+
+`google.cloud.bigquery` is only imported the first time a client is needed, so test modules that never log
+don't pay its import cost, and the underlying `bigquery.Client` (with its own HTTP transport) is created once
+per project and set of credentials and shared by everything that logs.
+"""
+import atexit
 import datetime
+import hashlib
 import logging
 import os
 import json
+import queue
+import threading
+import time
 
-from google.api_core.exceptions import ServiceUnavailable
-from google.cloud import bigquery
-from google.cloud.exceptions import Conflict
-from google.oauth2.service_account import Credentials
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 
 from test.utils import retry
 
+if TYPE_CHECKING:
+    from google.cloud import bigquery
+
 log = logging.getLogger(__name__)
 
+DEFAULT_PROJECT = 'unc-renci-bdc-itwg'
+
+_bigquery_clients: Dict[Tuple[str, str], 'bigquery.Client'] = {}
+_clients: Dict[str, 'Client'] = {}
+_clients_lock = threading.Lock()
+
+
+def bigquery_client(project: str = DEFAULT_PROJECT) -> 'bigquery.Client':
+    """
+    The shared `bigquery.Client` for `project` and the service account in ENCODED_GOOGLE_APPLICATION_CREDENTIALS.
+
+    Clients are keyed by a fingerprint of the credentials, so changing them mid-process gets a new client.
+    """
+    credentials_json = os.environ['ENCODED_GOOGLE_APPLICATION_CREDENTIALS']
+    key = (project, hashlib.sha256(credentials_json.encode('utf-8')).hexdigest())
+    with _clients_lock:
+        client = _bigquery_clients.get(key)
+        if client is None:
+            from google.cloud import bigquery
+            from google.oauth2.service_account import Credentials
+            credentials = Credentials.from_service_account_info(json.loads(credentials_json))
+            client = _bigquery_clients[key] = bigquery.Client(project=project, credentials=credentials)
+        return client
+
+
+def get_client(project: str = DEFAULT_PROJECT) -> 'Client':
+    """A process-wide `Client` for `project`, created on first use."""
+    with _clients_lock:
+        client = _clients.get(project)
+    if client is None:
+        client = Client(project)
+        with _clients_lock:
+            client = _clients.setdefault(project, client)
+    return client
+
+
+TABLE_CACHE_PATH = os.environ.get('BDCAT_BQ_TABLE_CACHE',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'bdcat-integration-tests', 'bq_tables.json'))
+TABLE_CACHE_TTL = float(os.environ.get('BDCAT_BQ_TABLE_CACHE_TTL', 7 * 24 * 60 * 60))
+SPILL_PATH = os.environ.get('BDCAT_BQ_SPILL_PATH',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'bdcat-integration-tests', 'bq_spill.jsonl'))
+# a spilled row is retried by this many later runs at most before it is moved to the rejected file
+MAX_SPILL_ATTEMPTS = 5
+
+
+class TableCache:
+    """
+    Tables (and the schemas they were created with) that are known to exist, persisted to a JSON file.
+
+    Entries expire `ttl` seconds after they were recorded, after which `create_table` will be called
+    for that table again.  The file is shared across processes; a missing or unreadable file is treated
+    as an empty cache.
+
+    :param path: Where to persist the cache.  None keeps it in memory only.
+    :param ttl: Seconds an entry stays valid.
+    """
+    def __init__(self, path: Optional[str] = TABLE_CACHE_PATH, ttl: float = TABLE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._tables: Optional[Dict[str, dict]] = None
+        self._lock = threading.Lock()
+        self.create_calls = 0
+        self.create_calls_avoided = 0
+
+    @staticmethod
+    def schema_fingerprint(schema) -> List[List[str]]:
+        return [[field.name, field.field_type, field.mode] for field in schema]
+
+    def _read(self) -> Dict[str, dict]:
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                log.warning('Ignoring unreadable BigQuery table cache: %s', self.path, exc_info=True)
+        return {}
+
+    def _load(self) -> Dict[str, dict]:
+        if self._tables is None:
+            self._tables = self._read()
+        return self._tables
+
+    def _save(self):
+        if self.path:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._tables, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                log.warning('Could not save BigQuery table cache: %s', self.path, exc_info=True)
+
+    def exists(self, table_id: str, schema) -> bool:
+        """True (and counted as an avoided create call) if `table_id` is known to exist with `schema`."""
+        with self._lock:
+            entry = self._load().get(table_id)
+            fresh = entry is not None and time.time() - entry['recorded'] < self.ttl
+            if fresh and entry['schema'] == self.schema_fingerprint(schema):
+                self.create_calls_avoided += 1
+                return True
+            self.create_calls += 1
+            return False
+
+    def add(self, table_id: str, schema):
+        with self._lock:
+            tables = self._load()
+            # pick up entries written by other processes since we loaded, so we don't clobber them
+            for other_id, entry in self._read().items():
+                if other_id not in tables or tables[other_id]['recorded'] < entry['recorded']:
+                    tables[other_id] = entry
+            tables[table_id] = {'recorded': time.time(), 'schema': self.schema_fingerprint(schema)}
+            now = time.time()
+            for expired in [t for t, entry in tables.items() if now - entry['recorded'] >= self.ttl]:
+                del tables[expired]
+            self._save()
+
+    def log_stats(self):
+        if self.create_calls or self.create_calls_avoided:
+            log.info('BigQuery create_table: %d calls made, %d avoided by the table cache',
+                     self.create_calls, self.create_calls_avoided)
+
+
+table_cache = TableCache()
+atexit.register(table_cache.log_stats)
+
+# the `create` argument of `ResultSink.add` and `BackgroundWriter.submit`: the kind of table to create before
+# writing to it, as the name of the `Client` method that creates it (True means a test results table)
+TABLE_KINDS = {'test': 'create_test_table',
+               'duration': 'create_duration_table',
+               'phase_timing': 'create_phase_timing_table'}
+Create = Union[bool, str, None]
+
+
+def _table_kind(create: Create) -> Optional[str]:
+    if create is True:
+        return 'test'
+    if not create:
+        return None
+    if create not in TABLE_KINDS:
+        raise ValueError(f'Unknown kind of table to create: {create!r}')
+    return create
+
 
 class Client:
 
-    def __init__(self, project='unc-renci-bdc-itwg'):
-        credentials = Credentials.from_service_account_info(json.loads(os.environ['ENCODED_GOOGLE_APPLICATION_CREDENTIALS']))
-        self.client = bigquery.Client(project=project, credentials=credentials)
+    def __init__(self, project=DEFAULT_PROJECT, client: Optional['bigquery.Client'] = None):
+        """:param client: The `bigquery.Client` to use instead of the shared one, e.g. one pointed at a stub."""
+        self.client = client if client is not None else bigquery_client(project)
 
-    @retry(errors={ServiceUnavailable})
     def add_row(self, table_id: str, row: dict):
-        rows_to_insert = [row]
-        errors = self.client.insert_rows_json(table_id, rows_to_insert)
+        self.add_rows(table_id, [row])
+
+    def add_rows(self, table_id: str, rows: List[dict]):
+        from google.api_core.exceptions import ServiceUnavailable
+        retry(errors={ServiceUnavailable})(self._insert_rows)(table_id, rows)
+
+    def _insert_rows(self, table_id: str, rows: List[dict]):
+        errors = self.client.insert_rows_json(table_id, rows)
         if errors:
             raise RuntimeError(f'Encountered errors while inserting rows: {errors}')
 
@@ -31,14 +191,20 @@ class Client:
         return list(q.result())
 
     def create_table(self, table_id, schema):
+        if table_cache.exists(table_id, schema):
+            return
+        from google.cloud import bigquery
+        from google.cloud.exceptions import Conflict
         table = bigquery.Table(table_id, schema=schema)
         try:
             table = self.client.create_table(table)
             log.info(f'Created table {table.project}.{table.dataset_id}.{table.table_id}')
         except Conflict:
             log.warning(f'Table {table.project}.{table.dataset_id}.{table.table_id} already exists')
+        table_cache.add(table_id, schema)
 
     def create_test_table(self, table_id):
+        from google.cloud import bigquery
         schema = [
             bigquery.SchemaField('t', 'TIMESTAMP', mode='REQUIRED'),
             bigquery.SchemaField('u', 'INTEGER', mode='REQUIRED'),
@@ -47,7 +213,32 @@ class Client:
         ]
         self.create_table(table_id, schema)
 
-    def log_test_results(self, test_name, status, timestamp, create=False):
+    def create_duration_table(self, table_id):
+        """A table for `log_duration`: one run time, in minutes, per row."""
+        from google.cloud import bigquery
+        schema = [
+            bigquery.SchemaField('t', 'TIMESTAMP', mode='REQUIRED'),
+            bigquery.SchemaField('d', 'FLOAT', mode='REQUIRED')
+        ]
+        self.create_table(table_id, schema)
+
+    def create_phase_timing_table(self, table_id):
+        """A table for `log_phase_timings`: one row per phase (or polled state) of one run of a test."""
+        from google.cloud import bigquery
+        schema = [
+            bigquery.SchemaField('t', 'TIMESTAMP', mode='REQUIRED'),
+            bigquery.SchemaField('run_id', 'STRING', mode='REQUIRED'),
+            bigquery.SchemaField('phase', 'STRING', mode='REQUIRED'),
+            bigquery.SchemaField('seconds', 'FLOAT', mode='REQUIRED'),
+            bigquery.SchemaField('source', 'STRING', mode='NULLABLE')
+        ]
+        self.create_table(table_id, schema)
+
+    def log_test_results(self, test_name, status, timestamp, create=False, sink: Optional['ResultSink'] = None):
+        """
+        Log a test's status.  The row is buffered in `sink` if one is given, and otherwise queued to the
+        background writer.
+        """
         table_id = f'unc-renci-bdc-itwg.bdc.integration_tests_{test_name}'
         if status != 'skip':
             if status == 'success':
@@ -58,18 +249,294 @@ class Client:
                 raise ValueError(f'Unexpected status: {status!r} for test: {test_name!r}')
             row = {f: (1 if f == field else 0) for f in ('u', 'd', 'm')}
             row['t'] = str(timestamp)
-            if create:
-                self.create_test_table(table_id)
-            self.add_row(table_id, row)
+            if sink is not None:
+                sink.add(table_id, row, create=create)
+            else:
+                background_writer().submit(table_id, row, create=create)
+
+
+class ResultSink:
+    """
+    Buffers rows for any number of tables and writes them in batches, one multi-row insert per table.
+
+    Buffered rows are written once `max_rows` rows are waiting, once the oldest buffered row is `max_age`
+    seconds old (checked whenever a row is added), when `flush()` is called, and at interpreter exit.
+
+    :param client: The Client to write with.  Created on the first flush if not given.
+    :param max_rows: Flush once this many rows are buffered across all tables.
+    :param max_age: Flush once the oldest buffered row has waited this many seconds.
+    :param batch_size: Maximum number of rows per insert request.
+    :param on_failure: Called with (table_id, rows, create, exception) for rows that could not be written.  By
+        default they are logged and dropped.
+    """
+    def __init__(self, client: Optional[Client] = None, max_rows: int = 500, max_age: float = 60.0,
+                 batch_size: int = 500,
+                 on_failure: Optional[Callable[[str, List[dict], Create, Exception], None]] = None):
+        self._client = client
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.on_failure = on_failure
+        self._rows: Dict[str, List[dict]] = {}
+        self._create: Dict[str, str] = {}
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @property
+    def client(self) -> Client:
+        if self._client is None:
+            self._client = get_client()
+        return self._client
+
+    def add(self, table_id: str, row: dict, create: Create = False):
+        """
+        Buffer `row` for `table_id`.
+
+        :param create: Make sure the table exists before writing to it: True for a test results table, or a
+            kind of table from `TABLE_KINDS`, e.g. 'phase_timing'.
+        """
+        kind = _table_kind(create)
+        with self._lock:
+            self._rows.setdefault(table_id, []).append(row)
+            if kind is not None:
+                self._create[table_id] = kind
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = sum(len(rows) for rows in self._rows.values()) >= self.max_rows
+            stale = time.monotonic() - self._oldest >= self.max_age
+        if full or stale:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows, handing any rows that could not be written to `on_failure`."""
+        with self._flush_lock:
+            with self._lock:
+                rows_by_table, self._rows = self._rows, {}
+                create, self._create = self._create, {}
+                self._oldest = None
+            for table_id, rows in rows_by_table.items():
+                written = 0
+                try:
+                    if table_id in create:
+                        getattr(self.client, TABLE_KINDS[create[table_id]])(table_id)
+                    while written < len(rows):
+                        self.client.add_rows(table_id, rows[written:written + self.batch_size])
+                        written += self.batch_size
+                except Exception as e:
+                    log.warning('Failed to write %d rows to %s', len(rows) - written, table_id, exc_info=True)
+                    if self.on_failure is not None:
+                        self.on_failure(table_id, rows[written:], create.get(table_id), e)
+
+
+def is_transient(e: Exception) -> bool:
+    """
+    Whether a failed write might succeed if retried later: a connection problem, a timeout, or a 429/5xx from
+    BigQuery.  Anything else (a missing table, rows rejected by the schema, ...) will fail the same way again.
+    """
+    import requests
+    if isinstance(e, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)):
+        return True
+    try:
+        from google.api_core.exceptions import ServerError, TooManyRequests
+        from google.auth.exceptions import TransportError
+    except ImportError:
+        return False
+    return isinstance(e, (ServerError, TooManyRequests, TransportError))
+
+
+class BackgroundWriter:
+    """
+    Writes rows to BigQuery from a daemon thread, so that logging never blocks (or retries inside) a test.
+
+    Rows are queued by `submit()` and batched through a `ResultSink` that is flushed whenever the queue has
+    been idle for `flush_interval` seconds.  Rows that fail to be written for a transient reason (see
+    `is_transient`), that arrive while the queue is full, or that are submitted after the writer has stopped,
+    are appended to a local JSON-lines spill file and re-queued the next time a writer starts, up to
+    `MAX_SPILL_ATTEMPTS` times.  Rows that BigQuery rejects outright, or that run out of attempts, are moved
+    to `<spill_path>.rejected` for inspection instead, so they aren't retried forever.  The queue is drained
+    at interpreter exit.
+
+    :param max_queue: Maximum number of rows waiting to be written.
+    :param flush_interval: Seconds of inactivity after which buffered rows are written.
+    :param spill_path: Where to keep rows that could not be written.
+    """
+    _STOP = object()
+
+    def __init__(self, max_queue: int = 10000, flush_interval: float = 5.0, spill_path: str = SPILL_PATH):
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._sink = ResultSink(on_failure=self._write_failed)
+        # id(row) -> (row, attempts) for replayed rows waiting in the sink; holding the row keeps its id unique
+        self._attempts: Dict[int, Tuple[dict, int]] = {}
+        self._thread = threading.Thread(target=self._run, name='bigquery-writer', daemon=True)
+        self._thread.start()
+        self._replay_spill()
+        atexit.register(self.drain)
+
+    @property
+    def alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def submit(self, table_id: str, row: dict, create: Create = False, attempts: int = 0):
+        """
+        Queue `row` to be written to `table_id` without blocking.
+
+        :param attempts: How many earlier runs already failed to write the row.
+        """
+        if not self.alive:
+            log.warning('BigQuery writer has stopped; spilling row for %s to %s', table_id, self.spill_path)
+            self._spill(table_id, [row], create, attempts)
+            return
+        try:
+            self._queue.put_nowait((table_id, row, create, attempts))
+        except queue.Full:
+            log.warning('BigQuery write queue is full; spilling row for %s to %s', table_id, self.spill_path)
+            self._spill(table_id, [row], create, attempts)
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush()
+                continue
+            try:
+                if item is self._STOP:
+                    self._flush()
+                    return
+                table_id, row, create, attempts = item
+                if attempts:
+                    self._attempts[id(row)] = (row, attempts)
+                self._sink.add(table_id, row, create)
+            except Exception:
+                log.warning('BigQuery writer failed', exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def drain(self, timeout: float = 120):
+        """Write everything queued so far and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                log.warning('Gave up waiting for %d queued BigQuery rows after %ss', self._queue.qsize(), timeout)
+
+    def _flush(self):
+        # every row handed to the sink so far has now been written or passed to _write_failed
+        self._sink.flush()
+        self._attempts.clear()
+
+    def _write_failed(self, table_id: str, rows: List[dict], create: Create, e: Exception):
+        for row in rows:
+            entry = self._attempts.pop(id(row), None)
+            attempts = entry[1] if entry is not None and entry[0] is row else 0
+            if is_transient(e):
+                self._spill(table_id, [row], create, attempts)
+            else:
+                self._spill(table_id, [row], create, attempts, path=f'{self.spill_path}.rejected', error=str(e))
+        if not is_transient(e):
+            log.error('BigQuery rejected %d rows for %s; moved them to %s.rejected: %s',
+                      len(rows), table_id, self.spill_path, e)
+
+    def _spill(self, table_id: str, rows: List[dict], create: Create, attempts: int = 0,
+               path: Optional[str] = None, error: Optional[str] = None):
+        path = path or self.spill_path
+        with self._spill_lock:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'a') as f:
+                    for row in rows:
+                        spilled = {'table_id': table_id, 'row': row, 'create': create, 'attempts': attempts}
+                        if error is not None:
+                            spilled['error'] = error
+                        f.write(json.dumps(spilled) + '\n')
+            except OSError:
+                log.warning('Could not spill %d rows for %s to %s', len(rows), table_id, path, exc_info=True)
+
+    def _replay_spill(self):
+        """Re-queue rows left in the spill file by an earlier run."""
+        replay_path = f'{self.spill_path}.{os.getpid()}.replay'
+        try:
+            os.replace(self.spill_path, replay_path)
+        except OSError:
+            return
+        with open(replay_path) as f:
+            for line in f:
+                try:
+                    spilled = json.loads(line)
+                except ValueError:
+                    continue
+                attempts = spilled.get('attempts', 0) + 1
+                if attempts > MAX_SPILL_ATTEMPTS:
+                    log.error('Giving up on a row for %s after %d attempts; moving it to %s.rejected',
+                              spilled['table_id'], attempts - 1, self.spill_path)
+                    self._spill(spilled['table_id'], [spilled['row']], spilled['create'], attempts - 1,
+                                path=f'{self.spill_path}.rejected', error='too many attempts')
+                else:
+                    self.submit(spilled['table_id'], spilled['row'], spilled['create'], attempts)
+        os.remove(replay_path)
+
+
+_background_writer: Optional[BackgroundWriter] = None
+_exiting = False
+
+
+def background_writer() -> BackgroundWriter:
+    """
+    The process-wide BackgroundWriter, started on first use and started again if it was drained.  Once the
+    interpreter is exiting the stopped writer is returned as is, and spills what it's given to disk.
+    """
+    global _background_writer
+    with _clients_lock:
+        if _background_writer is None or (not _background_writer.alive and not _exiting):
+            _background_writer = BackgroundWriter()
+        return _background_writer
+
+
+def drain():
+    """Wait for all queued BigQuery rows to be written."""
+    if _background_writer is not None:
+        _background_writer.drain()
+
+
+def _drain_at_exit():
+    global _exiting
+    with _clients_lock:
+        _exiting = True
+    drain()
+
+
+# registered at import, so it runs after the exit handlers of anything that may still log rows
+atexit.register(_drain_at_exit)
 
 
 def log_duration(table, duration, create_table=False):
-    if create_table:
-        Client().create_test_table(table)
+    """
+    Queue a run time to be written by the background writer; never raises or blocks the test.  With
+    `create_table`, the table is created, if need be, with `Client.create_duration_table`.
+    """
     try:
         # Track time in minutes
-        Client().add_row(table, {'t': str(datetime.datetime.now()), 'd': duration / 60})
-
+        background_writer().submit(table, {'t': str(datetime.datetime.now()), 'd': duration / 60},
+                                   create='duration' if create_table else False)
     except Exception:
         # We don't want failed logging to fail the whole test
         log.warning('Failed to log run time to BigQuery', exc_info=True)
+
+
+def log_phase_timings(table, run_id: str, durations: Dict[str, float], source: Optional[str] = None):
+    """
+    Queue one row per phase of a run (see `polling.PhaseTracker`) to be written by the background writer;
+    never raises or blocks the test.  The table is created, if need be, with `Client.create_phase_timing_table`.
+    """
+    try:
+        timestamp = str(datetime.datetime.now())
+        for phase, seconds in durations.items():
+            background_writer().submit(table, {'t': timestamp, 'run_id': run_id, 'phase': phase,
+                                               'seconds': seconds, 'source': source}, create='phase_timing')
+    except Exception:
+        log.warning('Failed to log phase timings to BigQuery', exc_info=True)
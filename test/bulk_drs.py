@@ -0,0 +1,95 @@
+"""
+Concurrent access sweeps over many DRS URIs.
+
+`import_drs_from_gen3` resolves one URI at a time (a Gen3 signed-URL request followed by a 2-byte ranged GCS
+read), which makes sweeping a whole study's indexd records take hours.  `check_drs_access` runs the same
+check over a bounded pool of worker threads and streams back one result per URI as soon as it finishes.
+"""
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from test import sessions
+from test.utils import import_drs_from_gen3
+
+log = logging.getLogger(__name__)
+
+
+class DRSAccessResult(NamedTuple):
+    drs_uri: str
+    status_code: Optional[int]  # None if no response was received at all
+    latency: float  # seconds
+    error: Optional[str] = None
+
+    @property
+    def accessible(self) -> bool:
+        return self.status_code is not None and 200 <= self.status_code < 300
+
+
+def _check(drs_uri: str, rate_limiters: List[sessions.RateLimiter]) -> DRSAccessResult:
+    # each check sends at most one request (plus retries) to each host, so a token per host per check keeps
+    # the sweep within its limits without touching the shared pool's
+    for rate_limiter in rate_limiters:
+        rate_limiter.acquire()
+    start = time.monotonic()
+    try:
+        response = import_drs_from_gen3(drs_uri, raise_for_status=False)
+    except Exception as e:
+        return DRSAccessResult(drs_uri, None, time.monotonic() - start, f'{type(e).__name__}: {e}')
+    error = None if response.ok else response.text[:500]
+    return DRSAccessResult(drs_uri, response.status_code, time.monotonic() - start, error)
+
+
+def check_drs_access(drs_uris: Iterable[str],
+                     workers: int = 16,
+                     rate_limits: Optional[Dict[str, float]] = None) -> Iterator[DRSAccessResult]:
+    """
+    Check access to each DRS URI with `import_drs_from_gen3`, `workers` at a time.
+
+    Results are yielded in completion order, not input order.  Only about 2 x `workers` URIs are in flight
+    or queued at once, so `drs_uris` may be a lazy iterable over a very large listing.
+
+    Connections are drawn from the shared pools in `test.sessions`; more workers than
+    BDCAT_HTTP_POOL_MAXSIZE will just wait for a free connection to the same host.
+
+    :param drs_uris: DRS URIs, e.g. drs://dg.712C/fa640b0e-9779-452f-99a6-16d833d15bd0
+    :param workers: Maximum number of URIs checked concurrently.
+    :param rate_limits: Maximum requests per second per host from this sweep, e.g.
+        {'storage.googleapis.com': 50}.  Other requests to the same hosts aren't limited.
+    """
+    rate_limiters = [sessions.RateLimiter(rate) for rate in (rate_limits or {}).values()]
+    uris = iter(drs_uris)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < 2 * workers:
+                try:
+                    in_flight.add(executor.submit(_check, next(uris), rate_limiters))
+                except StopIteration:
+                    exhausted = True
+            if not in_flight:
+                return
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def summarize(results: Iterable[DRSAccessResult]) -> Dict[str, float]:
+    """Consume `results` and return counts by status code plus latency stats, logging each failure."""
+    counts: Dict[str, float] = {}
+    latencies = []
+    for result in results:
+        key = str(result.status_code) if result.status_code is not None else 'error'
+        counts[key] = counts.get(key, 0) + 1
+        latencies.append(result.latency)
+        if not result.accessible:
+            log.info('%s -> %s: %s', result.drs_uri, key, result.error)
+    latencies.sort()
+    if latencies:
+        counts['total'] = len(latencies)
+        counts['latency_p50'] = latencies[len(latencies) // 2]
+        counts['latency_max'] = latencies[-1]
+    return counts
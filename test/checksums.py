@@ -0,0 +1,112 @@
+"""
+Fast local checksums for downloaded DRS objects, to compare against the md5 (and crc32c) in indexd.
+
+Files are read with `readinto` into one reusable buffer (or memory-mapped), and every requested checksum is
+updated from the same buffer so each file is only read once.  `checksum_files` spreads many files over a
+process pool so large batches use every core.
+"""
+import os
+import mmap
+import time
+import base64
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, NamedTuple, Optional, Sequence
+
+try:
+    import google_crc32c  # installed with google-resumable-media
+except ImportError:
+    google_crc32c = None
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+ALGORITHMS = ('md5', 'crc32c')
+
+
+class FileChecksums(NamedTuple):
+    path: str
+    size: int
+    seconds: float
+    md5: Optional[str] = None  # hex digest, as in indexd
+    crc32c: Optional[str] = None  # base64 of the big-endian checksum, as reported by GCS
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.size / (1024 * 1024) / self.seconds if self.seconds else 0.0
+
+
+class Checksummer:
+    """Updates every requested checksum from the same data, e.g. chunks of a download as they arrive."""
+
+    def __init__(self, algorithms: Sequence[str]):
+        unknown = set(algorithms) - set(ALGORITHMS)
+        if unknown:
+            raise ValueError(f'Unsupported checksum algorithm(s): {sorted(unknown)}.  Choose from: {ALGORITHMS}')
+        self._md5 = hashlib.md5() if 'md5' in algorithms else None
+        self._crc32c = None
+        if 'crc32c' in algorithms:
+            if google_crc32c is None:
+                raise RuntimeError('crc32c checksums require the google-crc32c package.')
+            self._crc32c = google_crc32c.Checksum()
+
+    def update(self, data):
+        if self._md5 is not None:
+            self._md5.update(data)
+        if self._crc32c is not None:
+            self._crc32c.update(data)
+
+    def result(self, path: str, size: int, seconds: float) -> FileChecksums:
+        return FileChecksums(path, size, seconds,
+                             md5=self._md5.hexdigest() if self._md5 is not None else None,
+                             crc32c=(base64.b64encode(self._crc32c.digest()).decode('utf-8')
+                                     if self._crc32c is not None else None))
+
+
+def checksum(path: str,
+             algorithms: Sequence[str] = ('md5',),
+             buffer_size: int = DEFAULT_BUFFER_SIZE,
+             use_mmap: bool = False) -> FileChecksums:
+    """
+    Compute the requested checksums of a file in a single pass.
+
+    :param algorithms: Any of 'md5' and 'crc32c'.
+    :param buffer_size: How many bytes to read (or hash from the memory map) at a time.
+    :param use_mmap: Memory-map the file instead of reading it into a buffer.
+    """
+    checksummer = Checksummer(algorithms)
+    start = time.perf_counter()
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), buffer_size):
+                        checksummer.update(view[offset:offset + buffer_size])
+                    size = len(view)
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                checksummer.update(view[:n])
+                size += n
+    return checksummer.result(path, size, time.perf_counter() - start)
+
+
+def _checksum_kwargs(args) -> FileChecksums:
+    path, kwargs = args
+    return checksum(path, **kwargs)
+
+
+def checksum_files(paths: Iterable[str], workers: Optional[int] = None, **kwargs) -> Iterator[FileChecksums]:
+    """
+    Checksum many files concurrently across `workers` processes (default: one per core), yielding results
+    in the same order as `paths`.  `kwargs` are passed to `checksum`.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_checksum_kwargs, ((path, kwargs) for path in paths))
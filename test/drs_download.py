@@ -0,0 +1,112 @@
+"""
+Download whole DRS objects and verify them against their indexd checksums, without writing them to disk.
+
+The object is split into byte ranges that are fetched in parallel over the pooled connections in
+`test.sessions`, and fed to the checksum in order as they arrive, so at most about 2 x `workers` ranges are
+held in memory at once.  A range whose connection drops partway through is resumed from the last byte
+received rather than fetched again from its start.
+"""
+import time
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from test import auth, sessions
+from test.checksums import Checksummer
+from test.utils import add_requester_pays_arg_to_url, drs_uri_to_guid, gen3_signed_url, indexd_record
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class VerifiedDownload(NamedTuple):
+    drs_uri: str
+    size: int
+    seconds: float
+    md5: str
+    expected_md5: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.expected_md5 is not None and self.md5 == self.expected_md5
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.size / (1024 * 1024) / self.seconds if self.seconds else 0.0
+
+
+def fetch_range(url: str, start: int, end: int, max_attempts: int = 5) -> bytes:
+    """
+    Fetch bytes `start` through `end` (inclusive) of `url`.
+
+    If the connection drops partway through, the request is resumed from the first missing byte, up to
+    `max_attempts` times in total.
+    """
+    expected = end - start + 1
+    data = bytearray()
+    attempt = 0
+    while len(data) < expected:
+        headers = {'Authorization': f'Bearer {auth.get_access_token()}',
+                   'Range': f'bytes={start + len(data)}-{end}'}
+        try:
+            with sessions.get(url, headers=headers, stream=True) as resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise RuntimeError(f'Expected a 206 partial response for {headers["Range"]}, '
+                                       f'got {resp.status_code}.')
+                for piece in resp.iter_content(chunk_size=64 * 1024):
+                    data += piece
+        except (ConnectionError, ChunkedEncodingError, Timeout) as e:
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            log.warning('Range %d-%d interrupted after %d bytes (%s); resuming.', start, end, len(data), e)
+            time.sleep(min(2 ** attempt, 30))
+    if len(data) != expected:
+        raise RuntimeError(f'Expected {expected} bytes for range {start}-{end}, got {len(data)}.')
+    return bytes(data)
+
+
+def download_and_verify(drs_uri: str,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        workers: int = 4,
+                        max_attempts: int = 5) -> VerifiedDownload:
+    """
+    Stream a DRS object through the gen3 signed-URL path and compare its md5 with indexd's.
+
+    :param chunk_size: Bytes per ranged request.
+    :param workers: How many ranges to fetch concurrently.
+    :param max_attempts: Attempts per range before giving up.
+    """
+    guid = drs_uri_to_guid(drs_uri)
+    record = indexd_record(drs_uri)
+    size = record['size']
+    url = add_requester_pays_arg_to_url(gen3_signed_url(drs_uri))
+    checksummer = Checksummer(('md5',))
+
+    start_time = time.perf_counter()
+    ranges = iter((start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        for _ in range(2 * workers):
+            next_range = next(ranges, None)
+            if next_range is None:
+                break
+            window.append(executor.submit(fetch_range, url, *next_range, max_attempts=max_attempts))
+        while window:
+            checksummer.update(window.popleft().result())
+            next_range = next(ranges, None)
+            if next_range is not None:
+                window.append(executor.submit(fetch_range, url, *next_range, max_attempts=max_attempts))
+    seconds = time.perf_counter() - start_time
+
+    result = checksummer.result(guid, size, seconds)
+    verified = VerifiedDownload(drs_uri, size, seconds, result.md5, record.get('hashes', {}).get('md5'))
+    log.info('%s: %d bytes in %.1fs (%.1f MB/s), md5 %s (indexd: %s)',
+             drs_uri, size, seconds, verified.mb_per_s, verified.md5, verified.expected_md5)
+    return verified
@@ -6,14 +6,16 @@ import unittest
 import sys
 import datetime
 
-from ..bq import Client
+from .. import sessions
+from ..bq import Client, drain, get_client
+from ..metrics import log_metrics
+from ..versions import compatibility, format_matrix, parse_version, version_probe
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 log = logging.getLogger(__name__)
 
-
-bdcat_prod_url = "https://gen3.biodatacatalyst.nhlbi.nih.gov"
-bdcat_staging_url = "https://staging.gen3.biodatacatalyst.nhlbi.nih.gov"
+# components whose staging version must not be behind prod; the others are only reported
+GATED_COMPONENTS = ('indexd',)
 
 
 class TestGen3VersionsAcrossEnvironments(unittest.TestCase):
@@ -35,33 +37,25 @@ class TestGen3VersionsAcrossEnvironments(unittest.TestCase):
         If PROD is updated before staging, that means a new version
         has been released without proper cross-org testing.
 
-        >>> bdcat_prod_version = "2021.12"
-        >>> bdcat_staging_version = "2022.01"
-        >>> bdcat_staging_version >= bdcat_prod_version
+        Versions are compared numerically, so "2021.10" is ahead of "2021.9":
+
+        >>> parse_version("2022.01") >= parse_version("2021.12")
         True
-        >>> bdcat_prod_version = "2021.05"
-        >>> bdcat_staging_version = "2021.04"
-        >>> bdcat_staging_version >= bdcat_prod_version
+        >>> parse_version("2021.04") >= parse_version("2021.05")
         False
-        >>> bdcat_staging_version = "2021.06"
-        >>> bdcat_prod_version = "2021.05"
-        >>> bdcat_staging_version >= bdcat_prod_version
+        >>> parse_version("2021.10") >= parse_version("2021.9")
         True
         '''
-        log.info("checking the gen3 release version on bdcat prod...")
-        bdcat_prod_version_json = requests.get(
-            f"{bdcat_prod_url}/index/_version"
-        ).json()
-        # extract version from json payload
-        bdcat_prod_version = bdcat_prod_version_json['version']
-
-        log.info("checking the gen3 release version on bdcat staging...")
-        bdcat_staging_version_json = requests.get(
-            f"{bdcat_staging_url}/index/_version"
-        ).json()
-        bdcat_staging_version = bdcat_staging_version_json['version']
+        log.info("checking the release versions on bdcat prod and staging...")
+        results = version_probe.probe(stages=('prod', 'staging'))
+        log.info("component versions:\n%s", format_matrix(results, ahead='staging', behind='prod'))
 
-        self.assertGreaterEqual(bdcat_staging_version, bdcat_prod_version)
+        matrix = compatibility(results, ahead='staging', behind='prod')
+        for component in GATED_COMPONENTS:
+            with self.subTest(component=component):
+                compat = matrix[component]
+                self.assertEqual(compat.status, 'ok',
+                                 f'{component} on staging ({compat.ahead}) vs prod ({compat.behind}): {compat.status}')
 
 
 if __name__ == "__main__":
@@ -70,7 +64,7 @@ if __name__ == "__main__":
 
     results = unittest.main(exit=False)
     timestamp = datetime.datetime.now()
-    client = Client()
+    client = get_client()
     all_failures = results.result.errors.extend(results.result.failures)
     if all_failures is not None:
         for test, status in all_failures:
@@ -88,4 +82,6 @@ if __name__ == "__main__":
             client.log_test_results(test_name, "success", timestamp, create=True)
         except Exception as e:
             log.exception('Failed to log test %r', test, exc_info=e)
+    drain()
+    log_metrics()
     sys.exit(not results.result.wasSuccessful())
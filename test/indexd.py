@@ -0,0 +1,182 @@
+"""
+A local SQLite copy of gen3's indexd records, for picking DRS URIs to test with.
+
+Listing indexd (`/index/index`) is paginated and slow for millions of records, so rather than filtering a
+fresh listing on every run (e.g. to find a restricted record the test user can't access), the listing is
+fetched once, several pages at a time, into a compact local index:
+
+    index = LocalIndex()
+    index.refresh()
+    index.get('dg.712C/01229405-6ce4-4ad7-aa04-19124afadebc').acl
+    index.sample(acl_not_in={'*', 'admin', 'topmed', 'phs000888'}, limit=1)
+
+indexd can't list only the records updated since a given date, so `refresh` still pages through the whole
+listing, but it only writes records whose `updated_date` is newer than the local copy.
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from requests.exceptions import HTTPError, ConnectionError
+
+from test import sessions
+from test.retry import retry
+from test.utils import GEN3_DOMAIN, STAGE, drs_uri_to_guid
+
+log = logging.getLogger(__name__)
+
+INDEX_PATH = os.environ.get('BDCAT_INDEXD_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'bdcat-integration-tests',
+                                         f'indexd_{STAGE}.sqlite'))
+
+PAGE_SIZE = 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    guid TEXT PRIMARY KEY,
+    size INTEGER,
+    md5 TEXT,
+    urls TEXT NOT NULL,
+    updated_date TEXT
+);
+CREATE TABLE IF NOT EXISTS acls (
+    guid TEXT NOT NULL,
+    acl TEXT NOT NULL,
+    PRIMARY KEY (acl, guid)
+);
+CREATE INDEX IF NOT EXISTS acls_by_guid ON acls (guid);
+"""
+
+
+class IndexdRecord(NamedTuple):
+    guid: str
+    acl: List[str]
+    size: Optional[int]
+    md5: Optional[str]
+    urls: List[str]
+    updated_date: Optional[str]
+
+    @property
+    def drs_uri(self) -> str:
+        return f'drs://{self.guid}'
+
+
+@retry(error_codes={429, 500, 502, 503, 504}, errors={HTTPError, ConnectionError}, circuit='gen3')
+def list_indexd_page(page: int, limit: int = PAGE_SIZE) -> List[dict]:
+    """One page of the indexd listing."""
+    resp = sessions.get(f'{GEN3_DOMAIN}/index/index', params={'page': page, 'limit': limit},
+                        headers={'Accept': 'application/json'})
+    resp.raise_for_status()
+    return resp.json()['records']
+
+
+class LocalIndex:
+    """
+    GUID -> (ACL, size, md5, urls) for every indexd record, kept in a SQLite file.
+
+    :param path: The SQLite file.  It is created if it doesn't exist.
+    """
+    def __init__(self, path: str = INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def _record(self, row) -> IndexdRecord:
+        guid, size, md5, urls, updated_date = row
+        acl = [acl for acl, in self._db.execute('SELECT acl FROM acls WHERE guid = ?', (guid,))]
+        return IndexdRecord(guid, acl, size, md5, json.loads(urls), updated_date)
+
+    def get(self, drs_uri: str) -> Optional[IndexdRecord]:
+        """The record for a GUID or DRS URI, or None if it isn't in the index."""
+        with self._lock:
+            row = self._db.execute('SELECT guid, size, md5, urls, updated_date FROM records WHERE guid = ?',
+                                   (drs_uri_to_guid(drs_uri),)).fetchone()
+            return None if row is None else self._record(row)
+
+    def sample(self,
+               acl_in: Optional[Set[str]] = None,
+               acl_not_in: Optional[Set[str]] = None,
+               max_size: Optional[int] = None,
+               limit: int = 1) -> List[IndexdRecord]:
+        """
+        Randomly pick up to `limit` records.
+
+        :param acl_in: Only records with at least one of these ACLs.
+        :param acl_not_in: Only records with none of these ACLs, e.g. public and granted ones to find a record
+            the test user shouldn't be able to access.
+        :param max_size: Only records at most this many bytes, to keep downloads short.
+        """
+        query = 'SELECT guid, size, md5, urls, updated_date FROM records r WHERE 1=1'
+        params: List = []
+        if acl_in:
+            query += f' AND EXISTS (SELECT 1 FROM acls a WHERE a.guid = r.guid AND a.acl IN ({",".join("?" * len(acl_in))}))'
+            params.extend(acl_in)
+        if acl_not_in:
+            query += f' AND NOT EXISTS (SELECT 1 FROM acls a WHERE a.guid = r.guid AND a.acl IN ({",".join("?" * len(acl_not_in))}))'
+            params.extend(acl_not_in)
+        if max_size is not None:
+            query += ' AND size <= ?'
+            params.append(max_size)
+        query += ' ORDER BY RANDOM() LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            return [self._record(row) for row in self._db.execute(query, params)]
+
+    def upsert(self, records: Iterable[dict]) -> int:
+        """Store indexd records (as returned by the API) that are new or newer than ours.  Returns how many."""
+        written = 0
+        with self._lock, self._db:
+            for record in records:
+                guid, updated_date = record['did'], record.get('updated_date')
+                row = self._db.execute('SELECT updated_date FROM records WHERE guid = ?', (guid,)).fetchone()
+                if row is not None and updated_date is not None and row[0] is not None and updated_date <= row[0]:
+                    continue
+                self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                                 (guid, record.get('size'), record.get('hashes', {}).get('md5'),
+                                  json.dumps(record.get('urls', [])), updated_date))
+                self._db.execute('DELETE FROM acls WHERE guid = ?', (guid,))
+                self._db.executemany('INSERT OR IGNORE INTO acls VALUES (?, ?)',
+                                     [(guid, acl) for acl in record.get('acl', [])])
+                written += 1
+        return written
+
+    def refresh(self, workers: int = 8, page_size: int = PAGE_SIZE) -> Dict[str, int]:
+        """
+        Page through the indexd listing, `workers` pages at a time, storing new and updated records.
+
+        :return: How many pages and records were read, and how many records were written.
+        """
+        stats = {'pages': 0, 'records': 0, 'written': 0}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            window = deque(executor.submit(list_indexd_page, page, page_size) for page in range(workers))
+            next_page = workers
+            while window:
+                records = window.popleft().result()
+                stats['pages'] += 1
+                stats['records'] += len(records)
+                stats['written'] += self.upsert(records)
+                if len(records) < page_size:
+                    # the last page; anything still in flight is past the end
+                    for future in window:
+                        future.cancel()
+                    break
+                window.append(executor.submit(list_indexd_page, next_page, page_size))
+                next_page += 1
+        log.info('Refreshed %s from %d indexd pages: %d records read, %d new or updated',
+                 self.path, stats['pages'], stats['records'], stats['written'])
+        return stats
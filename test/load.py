@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Open-loop load generation against a stage with the existing helpers.
+
+Requests arrive as a Poisson process whose rate ramps through a list of stages, e.g. `2:60,10:120` ramps
+from 0 to 2 requests/s over the first minute and then from 2 to 10 requests/s over the next two.  Arrivals
+are scheduled up front and dispatched on time whether or not earlier requests have finished (open loop), so
+a slow service faces a growing queue, as it would from independent users, rather than fewer requests.
+
+Latency is measured from when a request was *scheduled* to start, not from when a free virtual user picked
+it up, so time spent queued behind slow requests counts (no coordinated omission); the service time alone
+is reported too.  The helpers retry as they do in the tests, so latency includes retries and an error is a
+request that failed even after them.  Their circuit breakers are turned off unless `--circuit-breakers` is
+given, since an open breaker would fail requests on the client without the service ever seeing them; with
+it, such requests are counted as `rejected` rather than as errors.
+
+Against the local stub (as in CI):
+
+    python -m test.load --stub --stages 5:20,20:40 --mix drs=4,health=1 --max-error-rate 0.01
+
+and against staging, on demand:
+
+    BDCAT_STAGE=staging python -m test.load --stages 1:60,5:300 --mix drs=4,health=1,pfb=1
+
+The `pfb` and `workflow` scenarios start real PFB imports and md5sum submissions, so use them sparingly
+outside of the stub.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from test.metrics import Histogram, log_metrics
+from test.retry import CircuitOpenError, enable_circuit_breakers
+
+log = logging.getLogger(__name__)
+
+SCENARIOS = ('drs', 'pfb', 'workflow', 'health')
+
+STAGING_DRS_URI = 'drs://dg.712C/01229405-6ce4-4ad7-aa04-19124afadebc'
+PFB_FILE = 'https://cdistest-public-test-bucket.s3.amazonaws.com/export_2020-06-02T17_33_36.avro'
+
+
+class Stage(NamedTuple):
+    rate: float  # requests/s reached at the end of the stage
+    duration: float  # seconds
+
+
+def parse_stages(value: str) -> List[Stage]:
+    """'2:60,10:120' -> [Stage(rate=2.0, duration=60.0), Stage(rate=10.0, duration=120.0)]"""
+    stages = []
+    for part in value.split(','):
+        rate, duration = part.split(':')
+        stages.append(Stage(float(rate), float(duration)))
+    return stages
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """'drs=4,health=1' -> {'drs': 4.0, 'health': 1.0}"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise ValueError(f'Unknown scenario {name!r}; expected one of {SCENARIOS}.')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def arrival_times(stages: List[Stage], ramp: bool = True, rng: random.Random = random) -> List[Tuple[float, int]]:
+    """
+    (seconds from the start, stage index) of every arrival of a Poisson process through `stages`.
+
+    With `ramp`, the rate changes linearly from the previous stage's rate (0 for the first) to each stage's
+    own; otherwise it steps.  The varying rate is sampled by thinning a process at the stage's peak rate.
+    """
+    arrivals = []
+    start, previous_rate = 0.0, 0.0
+    for index, stage in enumerate(stages):
+        from_rate = previous_rate if ramp else stage.rate
+        peak = max(from_rate, stage.rate)
+        t = 0.0
+        while peak > 0:
+            t += rng.expovariate(peak)
+            if t >= stage.duration:
+                break
+            rate = from_rate + (stage.rate - from_rate) * t / stage.duration
+            if rng.random() * peak < rate:
+                arrivals.append((start + t, index))
+        start += stage.duration
+        previous_rate = stage.rate
+    return arrivals
+
+
+class ScenarioStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.service_time = Histogram()
+        self.requests = 0
+        self.errors: Dict[str, int] = {}
+        self.rejected = 0  # failed fast by an open circuit breaker, without reaching the service
+
+    def to_dict(self, duration: float) -> dict:
+        def ms(seconds: Optional[float]) -> Optional[float]:
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        failed = sum(self.errors.values())
+        sent = self.requests - self.rejected
+        return {'requests': self.requests,
+                'offered_per_s': round(self.requests / duration, 2),
+                'throughput_per_s': round((sent - failed) / duration, 2),
+                'error_rate': round(failed / sent, 4) if sent else 0.0,
+                'errors': dict(self.errors),
+                'rejected': self.rejected,
+                'latency_p50_ms': ms(self.latency.percentile(50)),
+                'latency_p95_ms': ms(self.latency.percentile(95)),
+                'latency_p99_ms': ms(self.latency.percentile(99)),
+                'service_p95_ms': ms(self.service_time.percentile(95))}
+
+
+class LoadTest:
+    """
+    Drives `scenarios` (name -> function making one request) in the proportions of `mix` through `stages`.
+
+    :param max_users: Requests in flight at once.  Arrivals beyond it wait for a free virtual user, and that
+        wait counts toward their latency.
+    :param ramp: Ramp the arrival rate linearly into each stage rather than stepping it.
+    :param seed: Seeds the arrival schedule and scenario choice, for repeatable runs.
+    """
+
+    def __init__(self,
+                 scenarios: Dict[str, Callable[[], object]],
+                 mix: Dict[str, float],
+                 stages: List[Stage],
+                 max_users: int = 256,
+                 ramp: bool = True,
+                 seed: Optional[int] = None):
+        self.scenarios = scenarios
+        self.mix = mix
+        self.stages = stages
+        self.max_users = max_users
+        self.ramp = ramp
+        self.rng = random.Random(seed)
+        self.stats: Dict[Tuple[int, str], ScenarioStats] = {}
+        self.max_dispatch_lag = 0.0
+        self._lock = threading.Lock()
+
+    def _call(self, stage: int, name: str, scheduled: float):
+        started = time.perf_counter()
+        error, rejected = None, False
+        try:
+            self.scenarios[name]()
+        except CircuitOpenError:
+            rejected = True
+        except Exception as e:
+            error = getattr(getattr(e, 'response', None), 'status_code', None) or type(e).__name__
+        finished = time.perf_counter()
+        with self._lock:
+            stats = self.stats.setdefault((stage, name), ScenarioStats())
+            stats.requests += 1
+            if rejected:
+                # never reached the service, so it says nothing about its latency
+                stats.rejected += 1
+                return
+            stats.latency.record(finished - scheduled)
+            stats.service_time.record(finished - started)
+            if error is not None:
+                stats.errors[str(error)] = stats.errors.get(str(error), 0) + 1
+
+    def run(self) -> dict:
+        """Run every stage and return `summary()`."""
+        arrivals = arrival_times(self.stages, self.ramp, self.rng)
+        names, weights = zip(*self.mix.items())
+        choices = self.rng.choices(names, weights, k=len(arrivals))
+        log.info('Scheduled %d requests over %.0fs.', len(arrivals), sum(stage.duration for stage in self.stages))
+        with ThreadPoolExecutor(max_workers=self.max_users, thread_name_prefix='virtual-user') as executor:
+            t0 = time.perf_counter()
+            for (offset, stage), name in zip(arrivals, choices):
+                scheduled = t0 + offset
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_dispatch_lag = max(self.max_dispatch_lag, -delay)
+                executor.submit(self._call, stage, name, scheduled)
+        return self.summary()
+
+    def summary(self) -> dict:
+        """Per stage: the stage's target rate and, per scenario and in total, throughput, errors and latency."""
+        stages = []
+        with self._lock:
+            for index, stage in enumerate(self.stages):
+                total = ScenarioStats()
+                scenarios = {}
+                for (stats_stage, name), stats in sorted(self.stats.items()):
+                    if stats_stage != index:
+                        continue
+                    scenarios[name] = stats.to_dict(stage.duration)
+                    total.requests += stats.requests
+                    total.rejected += stats.rejected
+                    for error, count in stats.errors.items():
+                        total.errors[error] = total.errors.get(error, 0) + count
+                    total.latency.merge(stats.latency)
+                    total.service_time.merge(stats.service_time)
+                stages.append({'stage': index,
+                               'target_rate_per_s': stage.rate,
+                               'duration_s': stage.duration,
+                               'total': total.to_dict(stage.duration),
+                               'scenarios': scenarios})
+        return {'stages': stages, 'max_dispatch_lag_s': round(self.max_dispatch_lag, 3)}
+
+
+def log_summary(summary: dict):
+    log.info('%-5s %-9s %-8s %8s %10s %8s %8s %8s %8s %8s', 'stage', 'target/s', 'scenario', 'requests',
+             'through/s', 'errors', 'rejected', 'p50 ms', 'p95 ms', 'p99 ms')
+    for stage in summary['stages']:
+        for name, row in [('total', stage['total'])] + sorted(stage['scenarios'].items()):
+            log.info('%-5d %-9s %-8s %8d %10.2f %7.2f%% %8d %8s %8s %8s', stage['stage'], stage['target_rate_per_s'],
+                     name, row['requests'], row['throughput_per_s'], row['error_rate'] * 100, row['rejected'],
+                     row['latency_p50_ms'], row['latency_p95_ms'], row['latency_p99_ms'])
+    if summary['max_dispatch_lag_s'] > 0.1:
+        log.warning('Arrivals were dispatched up to %.1fs late; the load generator itself was saturated.',
+                    summary['max_dispatch_lag_s'])
+
+
+def build_scenarios(drs_uris: List[str],
+                    signed_url_cache: bool = False,
+                    rng: random.Random = random) -> Tuple[Dict[str, Callable], Callable]:
+    """
+    The scenario functions for the current BDCAT_STAGE, and a function cleaning up after them.
+
+    :param rng: Picks the DRS URI of each `drs` request; pass a seeded one for repeatable runs.
+    """
+    from test import auth, utils
+    from test.signed_urls import SignedURLCache
+
+    if utils.STAGE == 'local':
+        auth.terra_token_cache = auth.TokenCache(lambda: 'load-test-token')
+    if not signed_url_cache:
+        # every virtual user would have a token of their own, so none would reuse another's signed URLs
+        utils.signed_url_cache = SignedURLCache(max_entries=0)
+
+    workspace = f'load-test-{uuid.uuid4()}'
+    workspace_created = threading.Event()
+    workspace_lock = threading.Lock()
+
+    def import_pfb():
+        with workspace_lock:
+            if not workspace_created.is_set():
+                utils.create_terra_workspace(workspace)
+                workspace_created.set()
+        utils.import_pfb(workspace, PFB_FILE)
+
+    def cleanup():
+        if workspace_created.is_set():
+            utils.delete_terra_workspace(workspace)
+
+    scenarios = {
+        'drs': lambda: utils.import_drs_from_gen3(rng.choice(drs_uris)),
+        'pfb': import_pfb,
+        'workflow': utils.run_workflow,
+        'health': utils.check_terra_health,
+    }
+    return scenarios, cleanup
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive open-loop synthetic traffic against BDCAT_STAGE.')
+    parser.add_argument('--stages', type=parse_stages, default=parse_stages('2:30,10:60'),
+                        help='Comma-separated rate:duration stages, in requests/s and seconds.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('drs=4,health=1'),
+                        help=f'Comma-separated scenario=weight, of {", ".join(SCENARIOS)}.')
+    parser.add_argument('--no-ramp', action='store_true', help='Step the rate between stages instead of ramping.')
+    parser.add_argument('--max-users', type=int, default=256, help='Requests in flight at once.')
+    parser.add_argument('--drs-uri', action='append', dest='drs_uris', help='DRS URI to import; may be repeated.')
+    parser.add_argument('--signed-url-cache', action='store_true',
+                        help="Reuse signed URLs between requests for the same DRS URI, as a single user would.")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--circuit-breakers', action='store_true',
+                        help='Keep the helpers\' circuit breakers on; requests they fail fast are counted as rejected.')
+    parser.add_argument('--stub', action='store_true', help='Run against the local stub (BDCAT_STAGE=local).')
+    parser.add_argument('--stub-latency', type=float, default=0.0)
+    parser.add_argument('--stub-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='Write the summary here as JSON.')
+    parser.add_argument('--max-error-rate', type=float,
+                        help='Exit non-zero if any stage had a higher overall error rate.')
+    args = parser.parse_args(argv)
+
+    stub = None
+    if args.stub:
+        from test.stub_server import spawn
+
+        stub, stub_url = spawn(latency=args.stub_latency, error_rate=args.stub_error_rate)
+        os.environ['BDCAT_STAGE'] = 'local'
+        os.environ['BDCAT_STUB_URL'] = stub_url
+    stage_name = os.environ.get('BDCAT_STAGE', 'staging')
+    drs_uris = args.drs_uris or ([f'drs://dg.STUB/{uuid.uuid4()}' for _ in range(100)]
+                                 if stage_name == 'local' else [STAGING_DRS_URI])
+    enable_circuit_breakers(args.circuit_breakers)
+    try:
+        scenarios, cleanup = build_scenarios(drs_uris, args.signed_url_cache, rng=random.Random(args.seed))
+        try:
+            load_test = LoadTest(scenarios, args.mix, args.stages, max_users=args.max_users,
+                                 ramp=not args.no_ramp, seed=args.seed)
+            summary = dict(load_test.run(), bdcat_stage=stage_name, mix=args.mix)
+        finally:
+            cleanup()
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.wait()
+
+    log_summary(summary)
+    log_metrics()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=4)
+    if args.max_error_rate is not None:
+        worst = max((stage['total']['error_rate'] for stage in summary['stages']), default=0.0)
+        if worst > args.max_error_rate:
+            log.error('Error rate %.2f%% is above the allowed %.2f%%.', worst * 100, args.max_error_rate * 100)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,246 @@
+"""
+Latency histograms, status codes, retries and bytes for every HTTP call the tests make.
+
+Calls made through `test.sessions` (Terra, Gen3, GCS, GitLab) and the SevenBridges broker client are
+recorded per service and endpoint template, e.g. ('rawls', 'GET /api/workspaces/{namespace}/{workspace}/
+submissions/{id}'), so that all submissions polled in a run land in one histogram no matter their ids.
+
+Latencies go into fixed log-spaced buckets (about 19% apart), so recording is O(1) and memory doesn't grow
+with the number of calls; percentiles are accurate to within one bucket.
+
+At the end of a run, `log_metrics()` logs a table of every endpoint, and `write_metrics(table_id)` writes
+one row per endpoint to BigQuery in a single insert.  If BDCAT_METRICS_TABLE is set, `log_metrics()` writes
+there too.
+"""
+import os
+import re
+import json
+import bisect
+import logging
+import datetime
+import threading
+
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+
+log = logging.getLogger(__name__)
+
+METRICS_TABLE = os.environ.get('BDCAT_METRICS_TABLE')
+
+# upper bounds (seconds) of the latency buckets: 1ms * 2**(i/4), up to ~18 minutes; anything slower goes in
+# a final overflow bucket
+BUCKET_BOUNDS = [0.001 * 2 ** (i / 4) for i in range(81)]
+
+SERVICES = (('rawls', 'rawls'),
+            ('orchestration', 'orchestration'),
+            ('gen3', 'gen3'),
+            ('storage.googleapis.com', 'gcs'),
+            ('sbgenomics', 'sevenbridges'),
+            ('gitlab', 'gitlab'),
+            ('biodata-integration-tests', 'gitlab'),
+            ('slack', 'slack'))
+
+_ID_PATTERNS = ((re.compile(r'^dg\.[0-9A-Za-z]+$'), '{prefix}'),
+                (re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'), '{id}'),
+                (re.compile(r'^[0-9a-fA-F]{16,}$'), '{id}'),
+                (re.compile(r'^\d+$'), '{n}'))
+
+
+def service_of(url: str) -> str:
+    hostname = urlsplit(url).hostname or ''
+    for fragment, service in SERVICES:
+        if fragment in hostname:
+            return service
+    return hostname
+
+
+def endpoint_template(url: str) -> str:
+    """The path of `url` with ids, workspace names and object names replaced by placeholders."""
+    parts = urlsplit(url)
+    if parts.hostname == 'storage.googleapis.com':
+        return '/{bucket}/{object}'
+    segments = parts.path.split('/')
+    template = []
+    names_left = 0
+    for segment in segments:
+        if names_left:
+            template.append('{namespace}' if names_left == 2 else '{workspace}')
+            names_left -= 1
+            continue
+        for pattern, placeholder in _ID_PATTERNS:
+            if pattern.match(segment):
+                segment = placeholder
+                break
+        template.append(segment)
+        if segment == 'workspaces':
+            names_left = 2
+    return '/'.join(template)
+
+
+class Histogram:
+    """Counts of values in the fixed `BUCKET_BOUNDS` buckets, plus their exact count, sum, min and max."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        """Add the values recorded in `other` to this histogram."""
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """The upper bound of the bucket holding the `p`th percentile (0-100), capped at the maximum seen."""
+        if not self.count:
+            return None
+        rank = max(1, round(self.count * p / 100))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(BUCKET_BOUNDS[index], self.max) if index < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.status_codes: Dict[str, int] = {}
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class Metrics:
+    """Thread-safe registry of `EndpointMetrics` keyed by (service, 'METHOD /endpoint/template')."""
+
+    def __init__(self):
+        self._endpoints: Dict[Tuple[str, str], EndpointMetrics] = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, method: str, url: str) -> EndpointMetrics:
+        key = (service_of(url), f'{method.upper()} {endpoint_template(url)}')
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = self._endpoints[key] = EndpointMetrics()
+        return endpoint
+
+    def record(self, method: str, url: str, seconds: float, status: str, bytes_sent: int = 0, bytes_received: int = 0):
+        """Record one call.  `status` is the HTTP status code, or e.g. 'ConnectionError' if there was no response."""
+        with self._lock:
+            endpoint = self._endpoint(method, url)
+            endpoint.latency.record(seconds)
+            endpoint.status_codes[status] = endpoint.status_codes.get(status, 0) + 1
+            endpoint.bytes_sent += bytes_sent
+            endpoint.bytes_received += bytes_received
+
+    def record_response(self, response: requests.Response, seconds: Optional[float] = None):
+        """Record a response; `seconds` defaults to the time until its headers arrived."""
+        request = response.request
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit():
+            received = int(content_length)
+        elif response._content_consumed and isinstance(response._content, bytes):
+            received = len(response._content)
+        else:
+            received = 0
+        self.record(request.method, request.url,
+                    response.elapsed.total_seconds() if seconds is None else seconds,
+                    str(response.status_code), _body_size(request.body), received)
+
+    def record_retry(self, e: Exception):
+        """Count a retry of the request that failed with `e`, if it was an HTTP request."""
+        response = getattr(e, 'response', None)
+        request = getattr(e, 'request', None) or getattr(response, 'request', None)
+        if request is None or not getattr(request, 'url', None):
+            return
+        with self._lock:
+            self._endpoint(request.method, request.url).retries += 1
+
+    def response_hook(self, response: requests.Response, *args, **kwargs):
+        """For `session.hooks['response']`, to record calls made through a session of its own."""
+        self.record_response(response)
+
+    def snapshot(self) -> List[dict]:
+        """One dict per endpoint, slowest (by p95) first."""
+        with self._lock:
+            rows = []
+            for (service, endpoint), endpoint_metrics in self._endpoints.items():
+                latency = endpoint_metrics.latency
+                rows.append({'service': service,
+                             'endpoint': endpoint,
+                             'count': latency.count,
+                             'mean': latency.mean,
+                             'p50': latency.percentile(50),
+                             'p95': latency.percentile(95),
+                             'p99': latency.percentile(99),
+                             'max': latency.max if latency.count else None,
+                             'status_codes': dict(endpoint_metrics.status_codes),
+                             'retries': endpoint_metrics.retries,
+                             'bytes_sent': endpoint_metrics.bytes_sent,
+                             'bytes_received': endpoint_metrics.bytes_received})
+        return sorted(rows, key=lambda row: row['p95'] or 0.0, reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+def _body_size(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return 0  # a stream or generator; its size isn't known up front
+
+
+metrics = Metrics()
+
+
+def _ms(seconds: Optional[float]) -> str:
+    return '-' if seconds is None else f'{seconds * 1000:.0f}'
+
+
+def log_metrics():
+    rows = metrics.snapshot()
+    if not rows:
+        return
+    log.info('%-14s %-70s %6s %8s %8s %8s %7s %s', 'service', 'endpoint', 'calls', 'p50 ms', 'p95 ms', 'p99 ms',
+             'retries', 'status codes')
+    for row in rows:
+        log.info('%-14s %-70s %6d %8s %8s %8s %7d %s', row['service'], row['endpoint'], row['count'],
+                 _ms(row['p50']), _ms(row['p95']), _ms(row['p99']), row['retries'], row['status_codes'])
+    if METRICS_TABLE:
+        try:
+            write_metrics(METRICS_TABLE)
+        except Exception:
+            log.exception('Failed to write HTTP metrics to %s', METRICS_TABLE)
+
+
+def write_metrics(table_id: str):
+    """Write one row per endpoint (status codes as a JSON string) to an existing BigQuery table in one insert."""
+    from test.bq import get_client
+
+    timestamp = str(datetime.datetime.now())
+    rows = [dict(row, t=timestamp, status_codes=json.dumps(row['status_codes'])) for row in metrics.snapshot()]
+    if rows:
+        get_client().add_rows(table_id, rows)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Run independent integration tests concurrently.
+
+Most of our tests spend their time waiting on remote services (the md5sum workflow alone can take an hour),
+so running them one after another makes a run take as long as the sum of all tests.  `ParallelTestRunner`
+runs test methods on a pool of worker threads instead, so a run takes about as long as its slowest test.
+
+Tests that touch the same remote state (e.g. the same Terra workspace) declare it, and are never run at the
+same time as each other:
+
+    @uses_resources('DRS-Test-Workspace')
+    def test_drs_workflow_in_terra(self):
+        ...
+
+The worker count defaults to BDCAT_TEST_WORKERS (4 if unset).  Several test modules can be run together with:
+
+    python -m test.parallel test.terra.test_terra test.seven_bridges.test_sevenbridges
+"""
+import io
+import os
+import sys
+import logging
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, FrozenSet, Iterator, List, Optional
+from unittest.runner import _WritelnDecorator
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.environ.get('BDCAT_TEST_WORKERS', 4))
+
+
+def uses_resources(*resources: str):
+    """Declare shared remote resources used by a test method or by every test in a TestCase class."""
+    def decorate(test_item):
+        test_item._bdcat_resources = frozenset(resources) | getattr(test_item, '_bdcat_resources', frozenset())
+        return test_item
+    return decorate
+
+
+def _resources_of(test: unittest.TestCase) -> FrozenSet[str]:
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    return getattr(type(test), '_bdcat_resources', frozenset()) | getattr(method, '_bdcat_resources', frozenset())
+
+
+def _flatten(suite) -> Iterator[unittest.TestCase]:
+    if isinstance(suite, unittest.TestSuite):
+        for test in suite:
+            yield from _flatten(test)
+    else:
+        yield suite
+
+
+class _ParallelSuite:
+    """Callable stand-in for a TestSuite that runs its tests on a thread pool and merges their results."""
+
+    def __init__(self, suite, runner: 'ParallelTestRunner'):
+        self.tests = list(_flatten(suite))
+        self.runner = runner
+        self._lock = threading.Lock()
+
+    def _set_up_classes(self, result) -> List[type]:
+        classes, failed = [], set()
+        for test in self.tests:
+            cls = type(test)
+            if cls in classes or cls in failed or getattr(cls, '__unittest_skip__', False):
+                continue
+            try:
+                cls.setUpClass()
+                classes.append(cls)
+            except unittest.SkipTest as e:
+                # e.g. Preflight.require_up with skip_down: the whole class is skipped, as TextTestRunner would
+                failed.add(cls)
+                for skipped_test in [t for t in self.tests if type(t) is cls]:
+                    result.startTest(skipped_test)
+                    result.addSkip(skipped_test, str(e))
+                    result.stopTest(skipped_test)
+            except Exception:
+                failed.add(cls)
+                exc_info = sys.exc_info()
+                for failed_test in [t for t in self.tests if type(t) is cls]:
+                    result.startTest(failed_test)
+                    result.addError(failed_test, exc_info)
+                    result.stopTest(failed_test)
+        self.tests = [t for t in self.tests if type(t) not in failed]
+        return classes
+
+    def _run_one(self, test: unittest.TestCase, result):
+        # Each test reports into its own result so that concurrent tests don't interleave their output
+        stream = _WritelnDecorator(io.StringIO())
+        test_result = self.runner.resultclass(stream, self.runner.descriptions, self.runner.verbosity)
+        test_result.failfast = result.failfast
+        # buffering swaps the process-wide sys.stdout/sys.stderr per test, which concurrent tests would clobber
+        test_result.buffer = False
+        test(test_result)
+        with self._lock:
+            self.runner.stream.write(stream.getvalue())
+            self.runner.stream.flush()
+            self._merge(result, test_result)
+
+    @staticmethod
+    def _merge(result, test_result):
+        result.testsRun += test_result.testsRun
+        for attr in ('failures', 'errors', 'skipped', 'expectedFailures', 'unexpectedSuccesses'):
+            getattr(result, attr).extend(getattr(test_result, attr))
+        # test durations are only collected from Python 3.12
+        if hasattr(result, 'collectedDurations') and hasattr(test_result, 'collectedDurations'):
+            result.collectedDurations.extend(test_result.collectedDurations)
+        if hasattr(result, 'tests_run') and hasattr(test_result, 'tests_run'):
+            result.tests_run.update(test_result.tests_run)
+        if test_result.shouldStop:
+            result.shouldStop = True
+
+    def __call__(self, result):
+        classes = self._set_up_classes(result)
+        pending = list(self.tests)
+        held: Dict = {}  # future -> resources it holds
+        with ThreadPoolExecutor(max_workers=self.runner.workers) as executor:
+            while pending or held:
+                busy = frozenset().union(*held.values())
+                for test in list(pending):
+                    if len(held) >= self.runner.workers or result.shouldStop:
+                        break
+                    resources = _resources_of(test)
+                    if resources & busy:
+                        continue
+                    pending.remove(test)
+                    busy |= resources
+                    held[executor.submit(self._run_one, test, result)] = resources
+                if not held:
+                    break
+                done, _ = wait(held, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del held[future]
+                    future.result()
+        if pending:
+            log.warning('Stopped early; %d tests were not run: %s', len(pending), ', '.join(test.id() for test in pending))
+        for cls in classes:
+            try:
+                cls.tearDownClass()
+            except Exception:
+                log.exception('tearDownClass failed for %s', cls.__qualname__)
+        return result
+
+
+class ParallelTestRunner(unittest.TextTestRunner):
+    """
+    A TextTestRunner that runs test methods concurrently, `workers` at a time.
+
+    Tests whose declared resources (see `uses_resources`) overlap are never run at the same time.
+    setUpClass/tearDownClass run once per class, before the first and after the last test.
+    """
+    def __init__(self, *args, workers: Optional[int] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.workers = workers or DEFAULT_WORKERS
+
+    def run(self, test):
+        if self.buffer:
+            log.warning('Output buffering (-b) is not supported when running tests in parallel; ignoring it.')
+        return super().run(_ParallelSuite(test, self))
+
+
+if __name__ == '__main__':
+    unittest.main(module=None, verbosity=2, testRunner=ParallelTestRunner)
@@ -0,0 +1,174 @@
+"""
+Polling long-running jobs (Terra submissions, PFB imports, SevenBridges test runs, GitLab pipelines).
+
+Each job is polled by its own coroutine, so several jobs can be awaited concurrently in one event loop:
+
+    submission, pfb_import = polling.wait_for_all(
+        polling.poll(check_submission, done=polling.state_in('Done', 'Aborted')),
+        polling.poll(check_pfb_import, done=polling.state_not_in('Pending', 'Translating')))
+
+The interval between polls backs off exponentially (with jitter, so concurrent pollers don't hit a service in
+lockstep) and resets whenever the job's observed state changes.
+"""
+import time
+import random
+import asyncio
+import logging
+import contextlib
+
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+_UNSET = object()
+
+
+class PollTimeout(TimeoutError):
+    """Raised when a job hasn't reached a terminal state by the deadline.  `last_result` is the final poll."""
+
+    def __init__(self, message: str, last_result: Any = None):
+        super().__init__(message)
+        self.last_result = last_result
+
+
+def state_in(*states: str, key: str = 'status') -> Callable[[dict], bool]:
+    """A `done` predicate: true once `response[key]` is one of `states`."""
+    return lambda response: response[key] in states
+
+
+def state_not_in(*states: str, key: str = 'status') -> Callable[[dict], bool]:
+    """A `done` predicate: true once `response[key]` has left the (non-terminal) `states`."""
+    return lambda response: response[key] not in states
+
+
+async def poll(fetch: Callable[[], T],
+               done: Callable[[T], bool],
+               *,
+               interval: float = 5.0,
+               max_interval: float = 60.0,
+               backoff: float = 1.5,
+               jitter: float = 0.2,
+               timeout: Optional[float] = None,
+               state: Optional[Callable[[T], Any]] = None,
+               on_result: Optional[Callable[[T], None]] = None) -> T:
+    """
+    Call `fetch` until `done(result)` is true and return that result.
+
+    :param fetch: Fetches the job's current status.  Blocking functions are run in the loop's default
+        executor; coroutine functions are awaited directly.
+    :param done: Returns True once the job is in a terminal state (or should stop being polled early, e.g.
+        one workflow of a submission has already failed).
+    :param interval: Seconds to wait before the second poll, and after any state change.
+    :param max_interval: The wait between polls never exceeds this many seconds.
+    :param backoff: The wait is multiplied by this after each poll that didn't see a state change.
+    :param jitter: Each wait is randomly scaled by up to +/- this fraction.
+    :param timeout: Seconds after which to give up with a `PollTimeout`.  None waits forever.
+    :param state: Extracts the job's state from a result.  When it changes, the wait resets to `interval`.
+    :param on_result: Called with every result, e.g. to log progress.
+    :raises PollTimeout: The job wasn't done after `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    delay = interval
+    last_state = _UNSET
+    while True:
+        if asyncio.iscoroutinefunction(fetch):
+            result = await fetch()
+        else:
+            result = await loop.run_in_executor(None, fetch)
+        if on_result is not None:
+            on_result(result)
+        if done(result):
+            return result
+        if state is not None:
+            current_state = state(result)
+            if current_state != last_state:
+                last_state, delay = current_state, interval
+        now = loop.time()
+        if deadline is not None and now >= deadline:
+            raise PollTimeout(f'Not done after {timeout}s. Last result: {result!r}', last_result=result)
+        wait = min(delay * random.uniform(1 - jitter, 1 + jitter), max_interval)
+        if deadline is not None:
+            wait = min(wait, deadline - now)
+        await asyncio.sleep(wait)
+        delay = min(delay * backoff, max_interval)
+
+
+def wait_for(fetch: Callable[[], T], done: Callable[[T], bool], **kwargs) -> T:
+    """Blocking version of `poll`, for callers that aren't running an event loop."""
+    return asyncio.run(poll(fetch, done, **kwargs))
+
+
+def wait_for_all(*polls: Awaitable, return_exceptions: bool = False) -> List:
+    """Run several `poll` coroutines concurrently and return their results in order."""
+    async def gather():
+        return await asyncio.gather(*polls, return_exceptions=return_exceptions)
+    return asyncio.run(gather())
+
+
+class PhaseTracker:
+    """
+    Times the phases of a multi-step job: explicit steps, and the states a poller sees the job go through.
+
+        tracker = PhaseTracker()
+        with tracker.phase('create_workspace'):
+            ...
+        wait_for(check_job, done=..., on_result=tracker.on_result)
+        tracker.durations  # {'create_workspace': 2.1, 'Translating': 31.0, 'Upserting': 12.4, 'Done': 0.0}
+
+    A polled state is timed from when it was first seen (or from the end of the previous phase, for the first
+    state seen) until a different state is seen, so times are only as precise as the polling interval.
+
+    :param state: Extracts the job's state from a poll result.
+    """
+    def __init__(self, state: Callable[[Any], str] = lambda response: response['status']):
+        self.state = state
+        self.started_at = time.monotonic()
+        self.durations: Dict[str, float] = {}
+        self.transitions: List[Tuple[float, str]] = []  # (seconds since start, phase or state entered)
+        self._current: Optional[str] = None
+        self._since = self.started_at
+
+    def _close(self, now: float):
+        if self._current is not None:
+            self.durations[self._current] = self.durations.get(self._current, 0.0) + now - self._since
+            self._current = None
+        self._since = now
+
+    def _enter(self, name: str, now: float):
+        self._close(now)
+        self._current = name
+        self.transitions.append((now - self.started_at, name))
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the body of the `with` block as `name`."""
+        self._enter(name, time.monotonic())
+        try:
+            yield
+        finally:
+            self._close(time.monotonic())
+
+    def on_result(self, result: Any):
+        """Pass as (or call from) `poll`'s `on_result` to time the job's states."""
+        state = self.state(result)
+        if state == self._current:
+            return
+        if self._current is None:
+            # the job has been in this state since the previous phase ended
+            self._current = state
+            self.transitions.append((self._since - self.started_at, state))
+        else:
+            self._enter(state, time.monotonic())
+
+    def finish(self) -> Dict[str, float]:
+        """Stop timing the current phase or state, and return the time spent in each."""
+        self._close(time.monotonic())
+        return self.durations
+
+    def breakdown(self) -> str:
+        total = sum(self.durations.values())
+        return ', '.join(f'{name}: {seconds:.1f}s ({100 * seconds / total if total else 0:.0f}%)'
+                         for name, seconds in self.durations.items())
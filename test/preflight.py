@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+One health check of the services a run depends on, shared by every suite in it.
+
+Orchestration, Rawls, Gen3 (fence) and the SevenBridges broker are checked concurrently, each with a short
+timeout.  The results are written to a small JSON file and reused by any process that starts within
+`max_age` seconds, so the separate suites of a run (e.g. `basic_submission` and `test_terra`) don't each
+check again.  A service found down is only trusted for `down_max_age` seconds, so that a blip doesn't skip
+every suite started in the next few minutes.  A lock on the file makes processes that start together wait
+for one check instead of all making their own.
+
+Tests declare what they depend on and fail straight away when it's down, instead of after an hour of polling
+an md5sum submission that can't make progress:
+
+    preflight = Preflight(terra_checks(ORC_DOMAIN, RAWLS_DOMAIN, GEN3_DOMAIN))
+
+    @preflight.requires('rawls', 'gen3')
+    def test_drs_workflow_in_terra(self):
+        ...
+
+An outage is a failed run, not a passing one, so such tests fail with `ServiceDownError`.  Runs that only
+want to test what is up (e.g. while debugging against a half-broken stage) can opt in to skipping them with
+BDCAT_PREFLIGHT_SKIP_DOWN=1.
+
+Run `python -m test.preflight` ahead of the suites to check the current BDCAT_STAGE and warm the file.
+"""
+import os
+import json
+import time
+import fcntl
+import logging
+import unittest
+import functools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, NamedTuple, Optional
+
+from test import sessions
+
+log = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get('BDCAT_PREFLIGHT_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'bdcat-integration-tests',
+                                         'preflight.json'))
+MAX_AGE = float(os.environ.get('BDCAT_PREFLIGHT_MAX_AGE', 300))
+DOWN_MAX_AGE = float(os.environ.get('BDCAT_PREFLIGHT_DOWN_MAX_AGE', 20))
+DEFAULT_TIMEOUT = 10.0
+SKIP_DOWN = os.environ.get('BDCAT_PREFLIGHT_SKIP_DOWN', '0') == '1'
+
+
+class ServiceDownError(AssertionError):
+    """A service a test requires is down.  An AssertionError, so the test is reported as failed."""
+
+
+class Check(NamedTuple):
+    url: str
+    # for services without a health endpoint: any response below 500 means it's up
+    up_if_reachable: bool = False
+
+
+class ServiceStatus(NamedTuple):
+    up: bool
+    detail: str
+    checked_at: float
+    seconds: float
+
+
+def terra_checks(orc_domain: str, rawls_domain: str, gen3_domain: str, broker_url: Optional[str] = None) -> Dict[str, Check]:
+    """The checks for one stage's Orchestration, Rawls, Gen3 and (default from BDCAT_SB_BROKER_URL) broker."""
+    if broker_url is None:
+        from test.seven_bridges.sb_broker import BROKER_URL as broker_url
+    return {'orchestration': Check(f'{orc_domain}/status'),
+            'rawls': Check(f'{rawls_domain}/status'),
+            'gen3': Check(f'{gen3_domain}/user/_status'),
+            'sevenbridges': Check(broker_url, up_if_reachable=True)}
+
+
+def _down_systems(response) -> str:
+    # Orchestration's /status lists the health of the systems behind it, e.g. {"systems": {"Rawls": {"ok": false}}}
+    try:
+        systems = response.json().get('systems') or {}
+    except (ValueError, AttributeError):
+        return ''
+    down = sorted(name for name, system in systems.items() if not (system or {}).get('ok', True))
+    return f'; down: {", ".join(down)}' if down else ''
+
+
+def check(service: Check, timeout: float = DEFAULT_TIMEOUT) -> ServiceStatus:
+    checked_at = time.time()
+    start = time.perf_counter()
+    try:
+        response = sessions.get(service.url, headers={'Accept': 'application/json'}, timeout=timeout)
+    except Exception as e:
+        return ServiceStatus(False, f'{type(e).__name__}: {e}', checked_at, time.perf_counter() - start)
+    up = response.status_code < 500 if service.up_if_reachable else response.ok
+    return ServiceStatus(up, f'HTTP {response.status_code}{_down_systems(response)}', checked_at,
+                         time.perf_counter() - start)
+
+
+class Preflight:
+    """
+    The health of the services in `checks` (name -> `Check`), checked at most once per `max_age` seconds
+    across all processes sharing `cache_path`.  Services that were down are checked again after
+    `down_max_age` seconds.
+
+    :param skip_down: Skip tests whose services are down instead of failing them.
+    """
+
+    def __init__(self,
+                 checks: Dict[str, Check],
+                 max_age: float = MAX_AGE,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 cache_path: str = CACHE_PATH,
+                 down_max_age: float = DOWN_MAX_AGE,
+                 skip_down: bool = SKIP_DOWN):
+        self.checks = checks
+        self.max_age = max_age
+        self.down_max_age = down_max_age
+        self.skip_down = skip_down
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self._statuses: Optional[Dict[str, ServiceStatus]] = None
+        self._lock = threading.Lock()
+
+    def _fresh(self, status: ServiceStatus) -> bool:
+        return time.time() - status.checked_at < (self.max_age if status.up else self.down_max_age)
+
+    def _read_cache(self) -> Dict[str, dict]:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, cached: Dict[str, dict]):
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f, indent=4)
+        os.replace(tmp_path, self.cache_path)
+
+    def status(self, refresh: bool = False) -> Dict[str, ServiceStatus]:
+        """
+        name -> `ServiceStatus` of every check.  Results up to `max_age` seconds old (`down_max_age` for
+        services that were down), from this or another process, are reused; the rest are checked concurrently.
+        """
+        with self._lock:
+            if self._statuses is not None and not refresh \
+                    and all(self._fresh(s) for s in self._statuses.values()):
+                return self._statuses
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            # cached results are keyed by URL, so checks of different stages don't mix
+            with open(f'{self.cache_path}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                cached = self._read_cache()
+                statuses = {}
+                for name, service in self.checks.items():
+                    entry = cached.get(service.url)
+                    if entry is not None and not refresh and self._fresh(ServiceStatus(**entry)):
+                        statuses[name] = ServiceStatus(**entry)
+                missing = [name for name in self.checks if name not in statuses]
+                if missing:
+                    with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='preflight') as executor:
+                        checked = executor.map(lambda name: check(self.checks[name], self.timeout), missing)
+                        statuses.update(zip(missing, checked))
+                    for name in missing:
+                        cached[self.checks[name].url] = statuses[name]._asdict()
+                        if not statuses[name].up:
+                            log.warning('Preflight: %s is down: %s', name, statuses[name].detail)
+                    self._write_cache(cached)
+            self._statuses = statuses
+            return statuses
+
+    def down(self, *names: str) -> Dict[str, ServiceStatus]:
+        """Those of `names` (all checks if none are given) that are down."""
+        statuses = self.status()
+        return {name: statuses[name] for name in (names or statuses) if not statuses[name].up}
+
+    def require_up(self, *names: str):
+        """
+        E.g. from `setUpClass` to fail (or skip) a whole suite.
+
+        :raises ServiceDownError: Any of `names` is down.
+        :raises unittest.SkipTest: Any of `names` is down and `skip_down` is set.
+        """
+        down = self.down(*names)
+        if down:
+            message = 'Preflight: ' + ', '.join(f'{name} is down ({s.detail})' for name, s in down.items())
+            raise unittest.SkipTest(message) if self.skip_down else ServiceDownError(message)
+
+    def requires(self, *names: str):
+        """Fail (or, with `skip_down`, skip) the decorated test if any of `names` is down when it starts."""
+        def decorate(test_method):
+            @functools.wraps(test_method)
+            def wrapper(*args, **kwargs):
+                self.require_up(*names)
+                return test_method(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def report(self) -> str:
+        now = time.time()
+        return '\n'.join(f'{name:<14} {"up" if s.up else "DOWN":<5} {s.seconds * 1000:6.0f} ms  {s.detail}'
+                         f'  (checked {max(now - s.checked_at, 0):.0f}s ago)'
+                         for name, s in self.status().items())
+
+
+def main():
+    from test.utils import GEN3_DOMAIN, ORC_DOMAIN, RAWLS_DOMAIN, STAGE
+
+    preflight = Preflight(terra_checks(ORC_DOMAIN, RAWLS_DOMAIN, GEN3_DOMAIN))
+    preflight.status(refresh=True)
+    print(f'Preflight [{STAGE}]:\n{preflight.report()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""
+Retrying flaky calls to remote services.
+
+`retry` wraps both plain functions and coroutine functions; the latter wait with `asyncio.sleep` so that a
+retrying coroutine doesn't block the event loop.  Calls can also share a `CircuitBreaker` per remote service:
+after enough consecutive server errors the breaker opens and calls fail fast with `CircuitOpenError` instead
+of piling more requests onto a degraded service, until a single probe call succeeds again.
+"""
+import time
+import random
+import asyncio
+import logging
+import datetime
+import functools
+import threading
+
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Set, Union
+from requests.exceptions import HTTPError, ConnectionError
+
+from test.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVALS = [1, 1, 2, 4, 8]
+
+# status codes whose Retry-After header we wait for
+RETRY_AFTER_STATUS_CODES = {429, 503}
+
+_stats_lock = threading.Lock()
+retry_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _count(func, stat: str):
+    name = f'{func.__module__}.{func.__qualname__}'
+    with _stats_lock:
+        stats = retry_stats.setdefault(name, {'calls': 0, 'retries': 0, 'gave_up': 0})
+        stats[stat] += 1
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds to wait according to the Retry-After header of a 429/503 HTTPError, if there is one."""
+    response = getattr(e, 'response', None)
+    if response is None or response.status_code not in RETRY_AFTER_STATUS_CODES:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails calls to a remote service fast while it is unhealthy.
+
+    closed: calls go through.  After `failure_threshold` consecutive failures (5xx responses or connection
+        errors) the breaker opens.
+    open: calls raise CircuitOpenError without being made.  After `reset_timeout` seconds it turns half-open.
+    half-open: one probe call goes through; others still fail fast.  If the probe succeeds the breaker
+        closes, otherwise it opens again for another `reset_timeout`.
+
+    A breaker that isn't `enabled` lets every call through and never opens (see `enable_circuit_breakers`).
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {'times_opened': 0, 'rejected': 0}
+        self.enabled = True
+
+    @staticmethod
+    def is_failure(e: Exception) -> bool:
+        if isinstance(e, ConnectionError):
+            return True
+        response = getattr(e, 'response', None)
+        return response is not None and response.status_code >= 500
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            return self._state
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError unless a call may go through right now.  Returns True if the call is the
+        half-open probe, which must be ended with `end_probe()` however it finishes.
+        """
+        if not self.enabled:
+            return False
+        state = self.state
+        with self._lock:
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._stats['rejected'] += 1
+        raise CircuitOpenError(f'Circuit breaker for {self.name} is {state}; not calling it.')
+
+    def end_probe(self):
+        """Let another probe through, e.g. after the last one was interrupted without a recorded result."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._state, self._consecutive_failures, self._probing = self.CLOSED, 0, False
+
+    def record_failure(self, e: Exception):
+        with self._lock:
+            if not self.enabled:
+                return
+            if not self.is_failure(e):
+                if getattr(e, 'response', None) is not None:
+                    # e.g. a 404: the service is up and answering, so this breaks any run of failures
+                    self._state, self._consecutive_failures, self._probing = self.CLOSED, 0, False
+                else:
+                    # e.g. a KeyError or bad JSON on our side: says nothing about the service either way
+                    self._probing = False
+                return
+            self._consecutive_failures += 1
+            if self._probing or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._stats['times_opened'] += 1
+                    log.warning('Opening circuit breaker for %s after %d consecutive failures',
+                                self.name, self._consecutive_failures)
+                self._state, self._opened_at, self._probing = self.OPEN, time.monotonic(), False
+
+    def stats(self) -> Dict[str, Union[str, int]]:
+        state = self.state
+        with self._lock:
+            return dict(self._stats, state=state, consecutive_failures=self._consecutive_failures)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_enabled = True
+
+
+def circuit_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """The shared CircuitBreaker called `name`, created with `kwargs` on first use."""
+    with _stats_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **kwargs)
+            _breakers[name].enabled = _breakers_enabled
+        return _breakers[name]
+
+
+def enable_circuit_breakers(enabled: bool = True):
+    """
+    Turn every shared circuit breaker, existing or created later, on or off.  E.g. a load test turns them off
+    so that it measures the service rather than requests failed fast on the client.
+    """
+    global _breakers_enabled
+    with _stats_lock:
+        _breakers_enabled = enabled
+        for breaker in _breakers.values():
+            breaker.enabled = enabled
+
+
+def retry(intervals: Optional[List] = None,
+          errors: Optional[Set] = None,
+          error_codes: Optional[Set] = None,
+          jitter: bool = True,
+          deadline: Optional[float] = None,
+          circuit: Optional[str] = None):
+    """
+    Retry a function if it fails with any Exception defined in the "errors" set, every x seconds,
+    where x is defined by a list of floats in "intervals".  If "error_codes" are specified,
+    retry on the HTTPError return codes defined in "error_codes".
+
+    Each call of the wrapped function gets its own copy of "intervals", so one flaky call doesn't use
+    up the retries of every later call.
+
+    Cases to consider:
+
+        error_codes ={} && errors={}
+            Retry on any Exception.
+
+        error_codes ={500} && errors={}
+        error_codes ={500} && errors={HTTPError}
+            Retry only on HTTPErrors that return status_code 500.
+
+        error_codes ={} && errors={HTTPError}
+            Retry on all HTTPErrors regardless of error code.
+
+        error_codes ={} && errors={AssertionError}
+            Only retry on AssertionErrors.
+
+    :param List[float] intervals: A list of times in seconds we keep retrying until returning failure.
+        Defaults to retrying with the following exponential backoff before failing:
+            1s, 1s, 2s, 4s, 8s
+
+    :param errors: Exceptions to catch and retry on.
+
+    :param error_codes: HTTPError return codes to retry on.  The default is an empty set.
+
+    :param jitter: If True, wait each interval plus a random extra of up to the interval again, so that many
+        callers failing at once don't all retry in lockstep.  Never waits less than the interval, so callers
+        keep at least the backoff budget their intervals were chosen for.
+
+    :param deadline: If set, stop retrying once this many seconds have passed since the first attempt,
+        and never sleep past that point.
+
+    :param circuit: The name of a CircuitBreaker (see `circuit_breaker`) shared by every function that calls
+        the same service.  While it is open, calls raise CircuitOpenError without being attempted or retried.
+
+    A 429 or 503 response with a Retry-After header waits at least as long as the header asks for.
+
+    Coroutine functions are supported, and wait between attempts without blocking the event loop.
+
+    :return: The result of the wrapped function or raise.
+    """
+    if intervals is None:
+        intervals = DEFAULT_INTERVALS
+    if error_codes is None:
+        error_codes = set()
+    if not error_codes and not errors:
+        errors = {Exception}
+    if error_codes and not errors:
+        errors = {HTTPError}
+    intervals = list(intervals)
+    errors = tuple(errors)
+
+    def next_wait(func, e: Exception, schedule, give_up_at: Optional[float]) -> float:
+        """How long to wait before the next attempt, or re-raise `e` if we shouldn't retry."""
+        if isinstance(e, HTTPError) and error_codes:
+            if getattr(e, 'response', None) is None or e.response.status_code not in error_codes:
+                raise e
+        interval = next(schedule, None)
+        if interval is None:
+            _count(func, 'gave_up')
+            raise e
+        if jitter:
+            interval += random.uniform(0, interval)
+        interval = max(interval, retry_after(e) or 0.0)
+        if give_up_at is not None and time.monotonic() + interval > give_up_at:
+            _count(func, 'gave_up')
+            raise e
+        _count(func, 'retries')
+        metrics.record_retry(e)
+        print(f"Error in {func}: {e}. Retrying after {interval:.1f} s...")
+        return interval
+
+    def decorate(func):
+        breaker = None if circuit is None else circuit_breaker(circuit)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def call_async(*args, **kwargs):
+                schedule = iter(intervals)
+                give_up_at = None if deadline is None else time.monotonic() + deadline
+                _count(func, 'calls')
+                while True:
+                    probing = breaker is not None and breaker.before_call()
+                    try:
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        if breaker is not None:
+                            breaker.record_failure(e)
+                        if not isinstance(e, errors):
+                            raise
+                        error = e
+                    else:
+                        if breaker is not None:
+                            breaker.record_success()
+                        return result
+                    finally:
+                        # a BaseException (e.g. KeyboardInterrupt, CancelledError) records nothing
+                        if probing:
+                            breaker.end_probe()
+                    await asyncio.sleep(next_wait(func, error, schedule, give_up_at))
+            return call_async
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            schedule = iter(intervals)
+            give_up_at = None if deadline is None else time.monotonic() + deadline
+            _count(func, 'calls')
+            while True:
+                probing = breaker is not None and breaker.before_call()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    if breaker is not None:
+                        breaker.record_failure(e)
+                    if not isinstance(e, errors):
+                        raise
+                    error = e
+                else:
+                    if breaker is not None:
+                        breaker.record_success()
+                    return result
+                finally:
+                    # a BaseException (e.g. KeyboardInterrupt) records nothing
+                    if probing:
+                        breaker.end_probe()
+                time.sleep(next_wait(func, error, schedule, give_up_at))
+        return call
+    return decorate
+
+
+def log_retry_stats():
+    with _stats_lock:
+        for name, stats in retry_stats.items():
+            if stats['retries'] or stats['gave_up']:
+                log.info('%s: %d calls, %d retries, gave up %d times',
+                         name, stats['calls'], stats['retries'], stats['gave_up'])
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        stats = breaker.stats()
+        if stats['times_opened'] or stats['rejected']:
+            log.info('Circuit breaker %s is %s: opened %d times, rejected %d calls',
+                     breaker.name, stats['state'], stats['times_opened'], stats['rejected'])
@@ -0,0 +1,235 @@
+"""
+Pooled HTTP sessions shared by every helper that talks to Terra, Gen3, GCS, etc.
+
+Module-level `requests.get/post/...` opens a fresh TCP+TLS connection for every call, which adds up quickly
+in the status-polling loops.  Instead, all calls are routed through one keep-alive `requests.Session` per
+domain (scheme + host), each with a bounded connection pool and a default timeout.
+"""
+import os
+import time
+import logging
+import threading
+
+from typing import Callable, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager
+
+from test.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# (connect, read) timeout in seconds, applied to any request that doesn't specify its own
+DEFAULT_TIMEOUT = (float(os.environ.get('BDCAT_HTTP_CONNECT_TIMEOUT', 10)),
+                   float(os.environ.get('BDCAT_HTTP_READ_TIMEOUT', 120)))
+# max number of connections kept open (and in flight) per host
+DEFAULT_POOL_MAXSIZE = int(os.environ.get('BDCAT_HTTP_POOL_MAXSIZE', 16))
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class _CountingPoolManager(PoolManager):
+    """A PoolManager whose connections call `on_connect` every time they open a new socket."""
+
+    def __init__(self, *args, on_connect: Callable[[], None], **kwargs):
+        self._on_connect = on_connect
+        super().__init__(*args, **kwargs)
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context=request_context)
+        on_connect = self._on_connect
+
+        class CountingConnection(pool.ConnectionCls):
+            def connect(self):
+                on_connect()
+                return super().connect()
+
+        pool.ConnectionCls = CountingConnection
+        return pool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter with a default timeout that counts how often connections were reused."""
+
+    def __init__(self, timeout: Timeout = DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        self._counter_lock = threading.Lock()
+        self._requests = 0
+        self._new_connections = 0
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = _CountingPoolManager(num_pools=connections,
+                                                maxsize=maxsize,
+                                                block=block,
+                                                on_connect=self._count_connection,
+                                                **pool_kwargs)
+
+    def _count_connection(self):
+        with self._counter_lock:
+            self._new_connections += 1
+
+    def send(self, request, timeout=None, **kwargs):
+        with self._counter_lock:
+            self._requests += 1
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+    def connection_stats(self) -> Dict[str, int]:
+        with self._counter_lock:
+            return {'requests': self._requests,
+                    'new_connections': self._new_connections,
+                    'reused_connections': max(self._requests - self._new_connections, 0)}
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket: allows `rate` calls per second on average, with bursts of up to `burst` calls.
+    """
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        if rate <= 0:
+            raise ValueError(f'rate must be positive, not: {rate}')
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SessionPool:
+    """
+    Lazily creates and hands out one pooled `requests.Session` per domain.
+
+    :param pool_maxsize: The number of connections to keep alive per host.
+    :param host_limits: Per-host overrides of `pool_maxsize`, e.g. {'storage.googleapis.com': 64}.
+    :param block: If True, never open more than the pool size of concurrent connections to one host;
+        extra callers wait for a free connection instead.
+    :param timeout: Default (connect, read) timeout for requests that don't pass one.
+    :param rate_limits: Optional max requests per second to send to a host, e.g. {'storage.googleapis.com': 50}.
+    """
+    def __init__(self,
+                 pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 host_limits: Optional[Dict[str, int]] = None,
+                 block: bool = True,
+                 timeout: Timeout = DEFAULT_TIMEOUT,
+                 rate_limits: Optional[Dict[str, float]] = None):
+        self.pool_maxsize = pool_maxsize
+        self.host_limits = host_limits or {}
+        self.block = block
+        self.timeout = timeout
+        self._sessions: Dict[str, requests.Session] = {}
+        self._adapters: Dict[str, PooledHTTPAdapter] = {}
+        self._rate_limiters: Dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+        for host, rate in (rate_limits or {}).items():
+            self.set_rate_limit(host, rate)
+
+    def set_rate_limit(self, host: str, rate: Optional[float]):
+        """Limit requests to `host` to `rate` per second, or remove the limit if `rate` is None."""
+        with self._lock:
+            if rate is None:
+                self._rate_limiters.pop(host, None)
+            else:
+                self._rate_limiters[host] = RateLimiter(rate)
+
+    @staticmethod
+    def _domain(url: str) -> str:
+        parts = urlsplit(url)
+        if not parts.scheme or not parts.netloc:
+            raise ValueError(f'Expected an absolute URL, not: {url}')
+        return f'{parts.scheme}://{parts.netloc}'
+
+    def session_for(self, url: str) -> requests.Session:
+        domain = self._domain(url)
+        session = self._sessions.get(domain)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(domain)
+                if session is None:
+                    maxsize = self.host_limits.get(urlsplit(domain).hostname, self.pool_maxsize)
+                    adapter = PooledHTTPAdapter(timeout=self.timeout,
+                                                pool_connections=1,
+                                                pool_maxsize=maxsize,
+                                                pool_block=self.block)
+                    session = requests.Session()
+                    session.mount(domain, adapter)
+                    self._adapters[domain] = adapter
+                    self._sessions[domain] = session
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        session = self.session_for(url)
+        rate_limiter = self._rate_limiters.get(urlsplit(url).hostname)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            metrics.record(method, url, time.perf_counter() - start, type(e).__name__)
+            raise
+        # for streamed responses this is the time until the headers arrived
+        metrics.record_response(response, time.perf_counter() - start)
+        return response
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Per-domain counts of requests made, connections opened, and connections reused."""
+        with self._lock:
+            return {domain: adapter.connection_stats() for domain, adapter in self._adapters.items()}
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._adapters.clear()
+
+
+pool = SessionPool()
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    return pool.request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return pool.request('GET', url, **kwargs)
+
+
+def head(url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault('allow_redirects', False)
+    return pool.request('HEAD', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return pool.request('POST', url, **kwargs)
+
+
+def put(url: str, **kwargs) -> requests.Response:
+    return pool.request('PUT', url, **kwargs)
+
+
+def delete(url: str, **kwargs) -> requests.Response:
+    return pool.request('DELETE', url, **kwargs)
+
+
+def log_connection_stats():
+    for domain, stats in pool.stats().items():
+        log.info('%s: %d requests over %d new connections (%d reused)',
+                 domain, stats['requests'], stats['new_connections'], stats['reused_connections'])
@@ -2,13 +2,15 @@ import logging
 import os
 import random
 import string
-import time
 from datetime import datetime, timezone
 from enum import Enum, unique
 from typing import Optional, List
 
 import requests
 
+from test import polling
+from test.metrics import metrics
+
 logger = logging.getLogger(__name__)
 
 BROKER_URL = os.getenv('BDCAT_SB_BROKER_URL', 'https://qa-broker.sbgenomics.com')
@@ -58,6 +60,7 @@ class SevenBridgesBrokerClient:
 
         self._base_url = base_url
         self._session = requests.Session()
+        self._session.hooks['response'].append(metrics.response_hook)
 
     @staticmethod
     def _check_response(resp, *, expected_code):
@@ -105,36 +108,40 @@ class SevenBridgesBrokerClient:
 
         :param task: Task data.
         :param timeout: How many seconds to wait before raising a TimeoutError.
-        :param poll_frequency: How often (in seconds) to check task state while waiting.
+        :param poll_frequency: How often (in seconds) to check task state while waiting; backs off
+            to at most 4x this while the state is unchanged.
         :raises TimeoutError: Not in a READY state after the given amount of time.
         :raises requests.HTTPError: Test run state could not be refreshed.
         :raises RuntimeError: Test run task is failed or revoked for some reason.
         """
         task_id = task['id']
         ready_states = {'SUCCESS', 'FAILURE', 'REVOKED'}
-        start_time = time.monotonic()
         logger.info('Waiting for test run %s to complete', task_id)
 
-        while time.monotonic() - start_time < timeout:
-            # Refresh task state
+        def refresh_task():
             resp = self.request('GET', f'/tasks/{task_id}')
             self._check_response(resp, expected_code=200)
-            task = resp.json()
-            logger.info('Test run %s is %s', task_id, task['state'])
-
-            if task['state'] in ready_states:
-                if task['state'] == 'SUCCESS':
-                    logger.info('Test run report: %s',
-                                f'{self._base_url}/reports/{task_id}')
-                    return task
-
-                raise RuntimeError('Test run {} is {}: {}'.format(
-                    task_id, task['state'], repr(task)
-                ))
-
-            time.sleep(poll_frequency)
-
-        raise TimeoutError(f'Task not ready after {timeout}s: {repr(task)}')
+            return resp.json()
+
+        try:
+            task = polling.wait_for(refresh_task,
+                                    done=polling.state_in(*ready_states, key='state'),
+                                    interval=poll_frequency,
+                                    max_interval=poll_frequency * 4,
+                                    timeout=timeout,
+                                    state=lambda t: t['state'],
+                                    on_result=lambda t: logger.info('Test run %s is %s', task_id, t['state']))
+        except polling.PollTimeout as e:
+            raise TimeoutError(f'Task not ready after {timeout}s: {repr(e.last_result)}')
+
+        if task['state'] == 'SUCCESS':
+            logger.info('Test run report: %s',
+                        f'{self._base_url}/reports/{task_id}')
+            return task
+
+        raise RuntimeError('Test run {} is {}: {}'.format(
+            task_id, task['state'], repr(task)
+        ))
 
     def assert_all_tests_passed(self, task: dict):
         """Get the test run report and assert that all tests have passed
@@ -9,10 +9,13 @@ pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noq
 sys.path.insert(0, pkg_root)  # noqa
 
 from .testmode import staging_only, production_only, uses_sb_broker
+from ..preflight import Check, Preflight
 
 
 logger = logging.getLogger(__name__)
 
+preflight = Preflight({'sevenbridges': Check(sb_broker.BROKER_URL, up_if_reachable=True)})
+
 
 class TestBDCIntegration(unittest.TestCase):
 
@@ -20,10 +23,12 @@ class TestBDCIntegration(unittest.TestCase):
 
     @staging_only
     @uses_sb_broker
+    @preflight.requires('sevenbridges')
     def test_bdc_staging(self):
         sb_broker.execute(sb_broker.SBEnv.staging, 'sbgtests.plans.bdc')
 
     @production_only
     @uses_sb_broker
+    @preflight.requires('sevenbridges')
     def test_bdc_production(self):
         sb_broker.execute(sb_broker.SBEnv.production, 'sbgtests.plans.bdc')
@@ -0,0 +1,119 @@
+"""
+In-memory cache of the signed Google Storage URLs returned by gen3's /user/data/download/{guid}.
+
+A signed URL stays valid until its expiry (the `Expires` parameter of V2 signatures, or `X-Goog-Date` plus
+`X-Goog-Expires` for V4), so probing the same GUID again (retries, repeated range reads, several checks in one
+run) can reuse it instead of asking gen3 to sign a new one.  URLs are cached per GUID and per token, since a
+URL signed for one identity shouldn't be handed to another, and are dropped `expiry_margin` seconds before
+they expire.
+"""
+import time
+import hashlib
+import logging
+import datetime
+import threading
+
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+log = logging.getLogger(__name__)
+
+
+def signed_url_expiry(url: str) -> Optional[float]:
+    """The unix time at which a signed GCS URL expires, or None if it doesn't say."""
+    params = {key.lower(): values[0] for key, values in parse_qs(urlsplit(url).query).items()}
+    try:
+        if 'expires' in params:
+            return float(params['expires'])
+        if 'x-goog-date' in params and 'x-goog-expires' in params:
+            signed_at = datetime.datetime.strptime(params['x-goog-date'], '%Y%m%dT%H%M%SZ')
+            signed_at = signed_at.replace(tzinfo=datetime.timezone.utc)
+            return signed_at.timestamp() + float(params['x-goog-expires'])
+    except ValueError:
+        log.warning('Could not parse the expiry of signed URL %s', url.split('?', 1)[0])
+    return None
+
+
+def token_identity(token: str) -> str:
+    """A short, non-reversible stand-in for a bearer token, so tokens aren't kept as cache keys."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+
+class SignedURLCache:
+    """
+    Thread-safe LRU cache of signed URLs keyed by (guid, token identity).
+
+    :param max_entries: The least recently used URL is evicted beyond this many entries.
+    :param expiry_margin: Stop handing out a URL this many seconds before it expires, so that a request
+        made with it doesn't race the expiry.
+    """
+    def __init__(self, max_entries: int = 1024, expiry_margin: float = 60):
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self._urls: 'OrderedDict[Tuple[str, str], Tuple[str, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'uncacheable': 0}
+
+    def get(self, guid: str, token: str) -> Optional[str]:
+        key = (guid, token_identity(token))
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None:
+                url, expires_at = entry
+                if time.time() < expires_at - self.expiry_margin:
+                    self._urls.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return url
+                del self._urls[key]
+                self._stats['expired'] += 1
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, guid: str, token: str, url: str):
+        expires_at = signed_url_expiry(url)
+        with self._lock:
+            if expires_at is None or time.time() >= expires_at - self.expiry_margin:
+                self._stats['uncacheable'] += 1
+                return
+            key = (guid, token_identity(token))
+            self._urls[key] = (url, expires_at)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def get_or_fetch(self, guid: str, token: str, fetch: Callable[[], str]) -> str:
+        """The cached URL for `guid`, or the URL returned by `fetch()` (which is then cached)."""
+        url = self.get(guid, token)
+        if url is None:
+            url = fetch()
+            self.put(guid, token, url)
+        return url
+
+    def invalidate(self, guid: str, token: Optional[str] = None):
+        """Forget the URL for `guid` (for every token, unless one is given), e.g. after GCS rejected it."""
+        with self._lock:
+            for key in list(self._urls):
+                if key[0] == guid and (token is None or key[1] == token_identity(token)):
+                    del self._urls[key]
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(self._stats, size=len(self._urls),
+                        hit_rate=self._stats['hits'] / lookups if lookups else 0.0)
+
+
+signed_url_cache = SignedURLCache()
+
+
+def log_signed_url_stats():
+    stats = signed_url_cache.stats()
+    log.info('Signed URL cache: %d hits, %d misses (%.0f%% hit rate), %d expired, %d evicted, %d uncacheable',
+             stats['hits'], stats['misses'], 100 * stats['hit_rate'], stats['expired'], stats['evicted'],
+             stats['uncacheable'])
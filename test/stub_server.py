@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Rawls, Orchestration, Gen3 (fence, indexd), GCS, SevenBridges broker and BigQuery
+streaming-insert endpoints that the test helpers call, for measuring our own client overhead without touching
+live services.
+
+    python -m test.stub_server --port 8900 --latency 0.05 --error-rate 0.01
+
+then run the helpers against it with:
+
+    BDCAT_STAGE=local BDCAT_STUB_URL=http://127.0.0.1:8900 BDCAT_SB_BROKER_URL=http://127.0.0.1:8900 ...
+
+Jobs (submissions, PFB imports, broker tasks) move one step through their configured state progression each
+time they are polled, so a poller sees every state.  Every response is delayed by `latency` seconds (+/- the
+`jitter` fraction) and fails with a 503 with probability `error_rate`, so retries and backoff get exercised.
+
+Only what the helpers read is emulated; state lives in memory and is lost when the server stops.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import socket
+import hashlib
+import argparse
+import threading
+import subprocess
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubConfig(NamedTuple):
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # each delay is randomly scaled by up to +/- this fraction
+    error_rate: float = 0.0  # probability of answering 503 instead
+    workflows_per_submission: int = 1
+    submission_states: Sequence[str] = ('Submitted', 'Running', 'Running', 'Done')
+    workflow_states: Sequence[str] = ('Queued', 'Submitted', 'Running', 'Running', 'Succeeded')
+    pfb_states: Sequence[str] = ('Pending', 'Translating', 'ReadyForUpsert', 'Upserting', 'Done')
+    broker_states: Sequence[str] = ('PENDING', 'STARTED', 'STARTED', 'SUCCESS')
+    object_size: int = 1024 * 1024  # bytes of each (generated) GCS object
+    gen3_version: str = '2021.05'
+    indexd_records: int = 1000
+    user: str = 'biodata.itwg.test.mule@gmail.com'
+
+
+def _object_bytes(guid: str, size: int) -> bytes:
+    """Deterministic content for a stub object, so downloads can be checked against its indexd md5."""
+    seed = hashlib.sha256(guid.encode('utf-8')).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def _public(job: dict) -> dict:
+    """A copy of a job without the stub's bookkeeping."""
+    return {key: [_public(v) if isinstance(v, dict) else v for v in value] if isinstance(value, list) else value
+            for key, value in job.items() if key != 'polls'}
+
+
+def _fake_jwt(claims: dict) -> str:
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode('utf-8')).rstrip(b'=').decode('utf-8')
+    return f'{encode({"alg": "none", "typ": "JWT"})}.{encode(claims)}.stub'
+
+
+class StubState:
+    """Everything the stub remembers between requests."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.workspaces: Dict[Tuple[str, str], dict] = {}
+        self.methodconfigs: Dict[Tuple[str, str], List[dict]] = {}
+        self.submissions: Dict[str, dict] = {}
+        self.pfb_jobs: Dict[str, dict] = {}
+        self.tasks: Dict[str, dict] = {}
+        self.requests = 0
+
+    def advance(self, job: dict, states: Sequence[str]) -> str:
+        """Move `job` one step along `states` (staying on the last one) and return its new state."""
+        job['polls'] = min(job.get('polls', -1) + 1, len(states) - 1)
+        return states[job['polls']]
+
+
+# (method, path regex, handler name); the first match wins
+ROUTES = [
+    ('GET', r'/status', 'orc_status'),
+    ('GET', r'/version', 'rawls_version'),
+    ('POST', r'/api/workspaces', 'create_workspace'),
+    ('DELETE', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)', 'delete_workspace'),
+    ('POST', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/methodconfigs', 'create_methodconfig'),
+    ('GET', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/methodconfigs', 'list_methodconfigs'),
+    ('DELETE', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/methodconfigs/(?P<config_ns>[^/]+)/(?P<name>[^/]+)',
+     'delete_methodconfig'),
+    ('POST', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/submissions', 'create_submission'),
+    ('GET', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/submissions/(?P<id>[^/]+)', 'get_submission'),
+    ('POST', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/importPFB', 'import_pfb'),
+    ('GET', r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)/importPFB/(?P<id>[^/]+)', 'get_pfb_job'),
+    ('POST', r'/user/credentials/api/access_token', 'gen3_access_token'),
+    ('GET', r'/user/data/download/(?P<guid>.+)', 'signed_url'),
+    ('HEAD', r'/user/data/download/(?P<guid>.+)', 'signed_url'),
+    ('GET', r'/index/_version', 'gen3_version'),
+    ('GET', r'/user/_version', 'gen3_version'),
+    ('GET', r'/user/_status', 'gen3_status'),
+    ('GET', r'/peregrine/_version', 'gen3_version'),
+    ('GET', r'/index/index', 'indexd_list'),
+    ('GET', r'/index/(?P<guid>.+)', 'indexd_record'),
+    ('GET', r'/gcs/(?P<guid>.+)', 'gcs_object'),
+    ('PUT', r'/tasks/(?P<id>[^/]+)', 'create_task'),
+    ('GET', r'/tasks/(?P<id>[^/]+)', 'get_task'),
+    ('GET', r'/reports/(?P<id>[^/]+)', 'get_report'),
+    ('POST', r'/bigquery/v2/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)/insertAll',
+     'bigquery_insert_all'),
+]
+_ROUTES = [(method, re.compile(f'^{pattern}$'), handler) for method, pattern, handler in ROUTES]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+    # headers and body are written separately; with Nagle's algorithm on, every response after the first on a
+    # connection waits ~40ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+    server: 'StubServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state
+
+    @property
+    def config(self) -> StubConfig:
+        return self.server.state.config
+
+    def _send(self, status: int, body=None, headers: Optional[Dict[str, str]] = None):
+        if isinstance(body, (dict, list)):
+            data = json.dumps(body).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            data = body or b''
+            content_type = 'application/octet-stream'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _dispatch(self):
+        parts = urlsplit(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        body = self._body()
+        with self.state.lock:
+            self.state.requests += 1
+        if self.config.latency:
+            time.sleep(self.config.latency * random.uniform(1 - self.config.jitter, 1 + self.config.jitter))
+        if random.random() < self.config.error_rate:
+            return self._send(503, {'message': 'stub: injected error'}, headers={'Retry-After': '0'})
+        for method, pattern, handler in _ROUTES:
+            match = pattern.match(parts.path)
+            if method == self.command and match:
+                return getattr(self, handler)(body=body, **match.groupdict())
+        self._send(404, {'message': f'stub: no route for {self.command} {parts.path}'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+    # Orchestration / Rawls
+
+    def orc_status(self, body):
+        self._send(200, {'ok': True, 'systems': {'Rawls': {'ok': True}, 'Thurloe': {'ok': True}}})
+
+    def rawls_version(self, body):
+        self._send(200, {'version': '0.1-stub'})
+
+    def create_workspace(self, body):
+        key = (body.get('namespace'), body.get('name'))
+        with self.state.lock:
+            if key in self.state.workspaces:
+                return self._send(409, {'message': f'Workspace {key[0]}/{key[1]} already exists'})
+            workspace = self.state.workspaces[key] = {'workspaceId': str(uuid.uuid4()), 'namespace': key[0],
+                                                      'name': key[1], 'createdBy': self.config.user}
+        self._send(201, workspace)
+
+    def delete_workspace(self, body, ns, ws):
+        with self.state.lock:
+            found = self.state.workspaces.pop((ns, ws), None)
+        if found is None:
+            return self._send(404, {'message': f'{ns}/{ws} does not exist'})
+        self._send(202, b'Your Google bucket will be deleted within 24h.')
+
+    def create_methodconfig(self, body, ns, ws):
+        with self.state.lock:
+            configs = self.state.methodconfigs.setdefault((ns, ws), [])
+            if any(c['name'] == body.get('name') and c['namespace'] == body.get('namespace') for c in configs):
+                return self._send(409, {'message': 'method config already exists'})
+            configs.append(body)
+        self._send(201, {'methodConfiguration': body})
+
+    def list_methodconfigs(self, body, ns, ws):
+        with self.state.lock:
+            configs = list(self.state.methodconfigs.get((ns, ws), []))
+        self._send(200, configs)
+
+    def delete_methodconfig(self, body, ns, ws, config_ns, name):
+        with self.state.lock:
+            configs = self.state.methodconfigs.get((ns, ws), [])
+            remaining = [c for c in configs if not (c['name'] == name and c['namespace'] == config_ns)]
+            self.state.methodconfigs[(ns, ws)] = remaining
+        self._send(204 if len(remaining) < len(configs) else 404)
+
+    def create_submission(self, body, ns, ws):
+        submission_id = str(uuid.uuid4())
+        workflows = [{'status': self.config.workflow_states[0],
+                      'workflowEntity': {'entityType': 'data_access_test_drs_uris', 'entityName': f'uri_{i}'},
+                      'inputResolutions': [{'inputName': 'md5sum.input_file',
+                                            'value': f'drs://dg.STUB/{uuid.uuid5(uuid.NAMESPACE_URL, str(i))}'}]}
+                     for i in range(self.config.workflows_per_submission)]
+        submission = {'submissionId': submission_id, 'status': self.config.submission_states[0],
+                      'submitter': self.config.user, 'workflows': workflows}
+        with self.state.lock:
+            self.state.submissions[submission_id] = submission
+        # like Rawls, the response lists each workflow's entity and inputs, but not yet a status or workflowId
+        self._send(201, {**submission,
+                         'workflows': [{'entityName': w['workflowEntity']['entityName'],
+                                        'inputResolutions': w['inputResolutions']} for w in workflows]})
+
+    def get_submission(self, body, ns, ws, id):
+        with self.state.lock:
+            submission = self.state.submissions.get(id)
+            if submission is None:
+                return self._send(404, {'message': f'submission {id} not found'})
+            for workflow in submission['workflows']:
+                workflow['status'] = self.state.advance(workflow, self.config.workflow_states)
+                if workflow['status'] != self.config.workflow_states[0]:
+                    workflow.setdefault('workflowId', str(uuid.uuid4()))
+            submission['status'] = self.state.advance(submission, self.config.submission_states)
+            if submission['status'] == self.config.submission_states[-1] and \
+                    any(w['status'] != self.config.workflow_states[-1] for w in submission['workflows']):
+                # a submission is only done once all of its workflows are
+                submission['polls'] -= 1
+                submission['status'] = self.config.submission_states[submission['polls']]
+            response = _public(submission)
+        self._send(200, response)
+
+    def import_pfb(self, body, ns, ws):
+        job_id = str(uuid.uuid4())
+        with self.state.lock:
+            self.state.pfb_jobs[job_id] = {'jobId': job_id, 'url': body.get('url'), 'status': self.config.pfb_states[0]}
+        self._send(202, {'jobId': job_id})
+
+    def get_pfb_job(self, body, ns, ws, id):
+        with self.state.lock:
+            job = self.state.pfb_jobs.get(id)
+            if job is None:
+                return self._send(404, {'message': f'job {id} not found'})
+            job['status'] = self.state.advance(job, self.config.pfb_states)
+            response = {'jobId': id, 'status': job['status'], 'message': ''}
+        self._send(200, response)
+
+    # Gen3: fence and indexd
+
+    def gen3_access_token(self, body):
+        self._send(200, {'access_token': _fake_jwt({'iss': self._base_url() + '/user', 'exp': int(time.time()) + 1200})})
+
+    def _base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def signed_url(self, body, guid):
+        if guid.startswith('drs://'):
+            guid = guid[len('drs://'):]
+        expires = int(time.time()) + 3600
+        self._send(200, {'url': f'{self._base_url()}/gcs/{guid}?GoogleAccessId=stub&Expires={expires}&Signature=stub'})
+
+    def gen3_status(self, body):
+        self._send(200, b'Healthy')
+
+    def gen3_version(self, body):
+        self._send(200, {'version': self.config.gen3_version, 'commit': 'stub'})
+
+    def _indexd_record(self, guid: str) -> dict:
+        data = _object_bytes(guid, self.config.object_size)
+        return {'did': guid, 'acl': ['*'], 'size': len(data), 'hashes': {'md5': hashlib.md5(data).hexdigest()},
+                'urls': [f'gs://stub-bucket/{guid}'], 'updated_date': '2021-01-01T00:00:00'}
+
+    def indexd_record(self, body, guid):
+        self._send(200, self._indexd_record(guid))
+
+    def indexd_list(self, body):
+        limit, page = int(self.query.get('limit', 100)), int(self.query.get('page', 0))
+        guids = range(page * limit, min((page + 1) * limit, self.config.indexd_records))
+        self._send(200, {'records': [self._indexd_record(f'dg.STUB/{uuid.uuid5(uuid.NAMESPACE_URL, str(i))}')
+                                     for i in guids]})
+
+    def gcs_object(self, body, guid):
+        data = _object_bytes(guid, self.config.object_size)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is None:
+            return self._send(200, data)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        self._send(206, data[start:end + 1], headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+    # SevenBridges broker
+
+    def create_task(self, body, id):
+        task = {'id': id, 'state': self.config.broker_states[0], 'test_ids': body.get('test_ids') or ['stub_test']}
+        with self.state.lock:
+            self.state.tasks[id] = task
+        self._send(201, _public(task))
+
+    def get_task(self, body, id):
+        with self.state.lock:
+            task = self.state.tasks.get(id)
+            if task is None:
+                return self._send(404, {'message': f'task {id} not found'})
+            task['state'] = self.state.advance(task, self.config.broker_states)
+            response = _public(task)
+        self._send(200, response)
+
+    def get_report(self, body, id):
+        with self.state.lock:
+            task = self.state.tasks.get(id)
+        if task is None:
+            return self._send(404, {'message': f'task {id} not found'})
+        self._send(200, {'id': id, 'results': [{'id': test_id, 'state': 'PASSED'} for test_id in task['test_ids']]})
+
+    # BigQuery (tabledata.insertAll, for bigquery.Client(client_options={'api_endpoint': stub.url}))
+
+    def bigquery_insert_all(self, body, project, dataset, table):
+        self._send(200, {'kind': 'bigquery#tableDataInsertAllResponse'})
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    The stub, served from a background thread when used as a context manager:
+
+        with StubServer(StubConfig(latency=0.05)) as stub:
+            requests.get(f'{stub.url}/status')
+    """
+    daemon_threads = True
+
+    def __init__(self, config: StubConfig = StubConfig(), host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), StubHandler)
+        self.state = StubState(config)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self.serve_forever, name='stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> 'StubServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def spawn(latency: float = 0.0, error_rate: float = 0.0, startup_timeout: float = 30.0) -> Tuple[subprocess.Popen, str]:
+    """
+    Run the stub in a subprocess on a free local port, so that its CPU time isn't counted against (and doesn't
+    contend for the GIL with) the client being measured.  Returns the process, once it accepts connections, and
+    its URL; `terminate()` the process when done.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, '-m', 'test.stub_server', '--port', str(port),
+                                '--latency', str(latency), '--error-rate', str(error_rate)],
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=subprocess.DEVNULL)
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'The stub server did not start on port {port}.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the BDCat services used by the tests.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Randomly scale each delay by up to +/- this.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503.')
+    parser.add_argument('--workflows-per-submission', type=int, default=1)
+    parser.add_argument('--object-size', type=int, default=1024 * 1024, help='Bytes per GCS object.')
+    args = parser.parse_args(argv)
+    config = StubConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        workflows_per_submission=args.workflows_per_submission, object_size=args.object_size)
+    server = StubServer(config, args.host, args.port)
+    print(f'Serving stub BDCat services on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+One client for the Terra (Rawls and Orchestration) APIs used by the integration tests.
+
+`test.utils` and the Terra suite used to carry their own copies of these calls.  The copies drifted apart:
+one retried and the other didn't, and they used different workspaces.  Now both build a `TerraClient` for
+their own stage config, and every call goes through the same pooled sessions, cached token and retry policy:
+
+    terra = TerraClient(rawls_domain=RAWLS_DOMAIN, orc_domain=ORC_DOMAIN, billing_project=BILLING_PROJECT)
+    submission = terra.run_workflow()
+    terra.check_workflow_status(submission['submissionId'])
+"""
+import json
+
+from typing import Callable, Optional, Tuple
+
+import requests
+
+from requests.exceptions import HTTPError, ConnectionError
+
+from .. import auth, sessions
+from ..retry import retry
+
+RETRY_ERROR_CODES = {429, 500, 502, 503, 504}
+RETRY_ERRORS = {HTTPError, ConnectionError}
+
+DOCKSTORE_METHOD_NAME = 'UM_aligner_wdl'
+DOCKSTORE_METHOD_PATH = 'github.com/DataBiosphere/topmed-workflows/UM_aligner_wdl'
+DOCKSTORE_METHOD_VERSION = '1.32.0'
+
+
+class TerraClient:
+    """
+    The Terra calls made by the integration tests, for one stage.
+
+    :param rawls_domain: e.g. 'https://rawls.dsde-alpha.broadinstitute.org'
+    :param orc_domain: e.g. 'https://firecloud-orchestration.dsde-alpha.broadinstitute.org'
+    :param billing_project: The namespace of every workspace used.
+    :param drs_workspace: The workspace the md5sum workflow is run in.
+    :param dockstore_workspace: The workspace dockstore workflows are imported into.
+    :param md5sum_namespace: The namespace of the md5sum method config in `drs_workspace`.
+    :param md5sum_entity: (entityType, entityName) to run md5sum on, or None to run the config as it is.
+    :param pool: Pooled sessions to make requests with.
+    :param token: Returns the Terra bearer token; defaults to the shared cached one.
+    """
+    def __init__(self,
+                 rawls_domain: str,
+                 orc_domain: str,
+                 billing_project: str,
+                 drs_workspace: str = 'DRS-Test-Workspace',
+                 dockstore_workspace: str = 'BDC_Dockstore_Import_Test',
+                 md5sum_namespace: str = 'drs_tests',
+                 md5sum_entity: Optional[Tuple[str, str]] = None,
+                 pool: sessions.SessionPool = sessions.pool,
+                 token: Callable[[], str] = auth.get_access_token):
+        self.rawls_domain = rawls_domain
+        self.orc_domain = orc_domain
+        self.billing_project = billing_project
+        self.drs_workspace = drs_workspace
+        self.dockstore_workspace = dockstore_workspace
+        self.md5sum_namespace = md5sum_namespace
+        self.md5sum_entity = md5sum_entity
+        self.pool = pool
+        self._token = token
+
+    def _headers(self, content_type: Optional[str] = 'application/json', accept: str = 'application/json') -> dict:
+        headers = {'Accept': accept, 'Authorization': f'Bearer {self._token()}'}
+        if content_type:
+            headers['Content-Type'] = content_type
+        return headers
+
+    def _json(self, resp: requests.Response) -> dict:
+        if not resp.ok:
+            print(resp.content)
+            resp.raise_for_status()
+        return resp.json()
+
+    def _workspace_url(self, domain: str, workspace: str) -> str:
+        return f'{domain}/api/workspaces/{self.billing_project}/{workspace}'
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='orchestration')
+    def check_terra_health(self) -> dict:
+        # note: the same endpoint seems to be at: https://api.alpha.firecloud.org/status
+        return self._json(self.pool.request('GET', f'{self.orc_domain}/status'))
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='rawls')
+    def import_dockstore_wf_into_terra(self) -> dict:
+        data = {
+            "namespace": self.billing_project,
+            "name": DOCKSTORE_METHOD_NAME,
+            "rootEntityType": "",
+            "inputs": {},
+            "outputs": {},
+            "prerequisites": {},
+            "methodRepoMethod": {
+                "sourceRepo": "dockstore",
+                "methodPath": DOCKSTORE_METHOD_PATH,
+                "methodVersion": DOCKSTORE_METHOD_VERSION
+            },
+            "methodConfigVersion": 1,
+            "deleted": False
+        }
+        endpoint = f'{self._workspace_url(self.rawls_domain, self.dockstore_workspace)}/methodconfigs'
+        return self._json(self.pool.request('POST', endpoint, headers=self._headers(), data=json.dumps(data)))
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='rawls')
+    def check_workflow_presence_in_terra_workspace(self) -> list:
+        endpoint = f'{self._workspace_url(self.rawls_domain, self.dockstore_workspace)}/methodconfigs?allRepos=true'
+        return self._json(self.pool.request('GET', endpoint, headers=self._headers(content_type=None)))
+
+    def check_workflow_seen_in_terra(self) -> bool:
+        for wf_response in self.check_workflow_presence_in_terra_workspace():
+            method_info = wf_response['methodRepoMethod']
+            if method_info['methodPath'] == DOCKSTORE_METHOD_PATH \
+                    and method_info['sourceRepo'] == 'dockstore' \
+                    and method_info['methodVersion'] == DOCKSTORE_METHOD_VERSION:
+                return True
+        return False
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='rawls')
+    def delete_workflow_presence_in_terra_workspace(self) -> dict:
+        endpoint = (f'{self._workspace_url(self.rawls_domain, self.dockstore_workspace)}'
+                    f'/methodconfigs/{self.billing_project}/{DOCKSTORE_METHOD_NAME}')
+        resp = self.pool.request('DELETE', endpoint, headers=self._headers(content_type=None))
+        resp.raise_for_status()
+        return {}
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='rawls')
+    def run_workflow(self, entity: Optional[Tuple[str, str]] = None, expression: Optional[str] = None) -> dict:
+        """
+        Submit the md5sum method config.
+
+        :param entity: (entityType, entityName) to run on instead of `md5sum_entity`, e.g. an entity set
+            so that one submission runs a workflow per member.
+        :param expression: Selects the entities to run on, relative to `entity`.
+        """
+        # staging input: https://gen3.biodatacatalyst.nhlbi.nih.gov/files/dg.712C/fa640b0e-9779-452f-99a6-16d833d15bd0
+        # prod input: https://gen3.biodatacatalyst.nhlbi.nih.gov/files/dg.4503/d52a7cc6-67a5-4bd6-9041-a5dad3f3650a
+        # md5sum: e87ecd9c771524dcc646c8baf6f8d3e2
+        data = {
+            "methodConfigurationNamespace": self.md5sum_namespace,
+            "methodConfigurationName": "md5sum",
+            "expression": expression or "this.data_access_test_drs_uriss",
+            "useCallCache": False,
+            "deleteIntermediateOutputFiles": True,
+            "workflowFailureMode": "NoNewCalls"
+        }
+        entity = entity or self.md5sum_entity
+        if entity is not None:
+            data["entityType"], data["entityName"] = entity
+        endpoint = f'{self._workspace_url(self.rawls_domain, self.drs_workspace)}/submissions'
+        return self._json(self.pool.request('POST', endpoint, headers=self._headers(), data=json.dumps(data)))
+
+    # polled for up to an hour while md5sum runs, so this call isn't on the rawls circuit breaker: it opens
+    # after 5 failures, before this call's own retries are used up, and one burst of 5xx would end the poll
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS)
+    def check_workflow_status(self, submission_id: str) -> dict:
+        endpoint = f'{self._workspace_url(self.rawls_domain, self.drs_workspace)}/submissions/{submission_id}'
+        return self._json(self.pool.request('GET', endpoint, headers=self._headers(content_type=None)))
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='rawls')
+    def create_terra_workspace(self, workspace: str) -> dict:
+        data = dict(namespace=self.billing_project,
+                    name=workspace,
+                    authorizationDomain=[],
+                    attributes={'description': ''},
+                    copyFilesWithPrefix='notebooks/')
+        return self._json(self.pool.request('POST', f'{self.rawls_domain}/api/workspaces',
+                                            headers=self._headers(), data=json.dumps(data)))
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='rawls')
+    def delete_terra_workspace(self, workspace: str) -> requests.Response:
+        """Returns the response as is (a 404 once the workspace is gone) rather than raising."""
+        return self.pool.request('DELETE', self._workspace_url(self.rawls_domain, workspace),
+                                 headers=self._headers(content_type=None, accept='text/plain'))
+
+    @retry(error_codes=RETRY_ERROR_CODES, errors=RETRY_ERRORS, circuit='orchestration')
+    def import_pfb(self, workspace: str, pfb_file: str) -> dict:
+        endpoint = f'{self._workspace_url(self.orc_domain, workspace)}/importPFB'
+        return self._json(self.pool.request('POST', endpoint, headers=self._headers(), data=json.dumps(dict(url=pfb_file))))
+
+    # this timeout interval maybe overkill... but...
+    # if the status timesout and the job is still running,
+    # the workspace may be deleted too soon, orphaning the job
+    # (so this call isn't on the orchestration circuit breaker, which would open after 5 failures and cut
+    # these retries short)
+    @retry(error_codes=RETRY_ERROR_CODES,
+           errors=RETRY_ERRORS,
+           intervals=[1, 1, 2, 4, 8, 16, 32, 64])
+    def pfb_job_status_in_terra(self, workspace: str, job_id: str) -> dict:
+        endpoint = f'{self._workspace_url(self.orc_domain, workspace)}/importPFB/{job_id}'
+        return self._json(self.pool.request('GET', endpoint, headers=self._headers(content_type=None)))
@@ -0,0 +1,158 @@
+"""
+Follow every workflow of a Terra submission with one status request per poll.
+
+Running md5sum over many DRS URIs as separate submissions means one submission and one polling loop per URI.
+Instead, submit once over an entity set (one workflow per member) and poll the submission, which reports
+the status of all of its workflows at once:
+
+    monitor = SubmissionMonitor.submit(terra, entity=('data_access_test_drs_uris_set', 'md5sum_batch'))
+    monitor.wait(timeout=60 * 60)
+    monitor.latency_percentiles()  # {50: 241.3, 90: 305.0, 99: 318.2} seconds from submission to finish
+"""
+import time
+import logging
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .. import polling
+from .client import TerraClient
+
+log = logging.getLogger(__name__)
+
+TERMINAL_SUBMISSION_STATES = ('Done', 'Aborted')
+TERMINAL_WORKFLOW_STATES = ('Succeeded', 'Failed', 'Aborted')
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """The `p`th percentile (0-100) of `values` by linear interpolation, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def _workflow_key(index: int, workflow: dict) -> str:
+    # workflowId is only assigned once Cromwell picks the workflow up; the entity is known from the start
+    entity = workflow.get('workflowEntity') or {}
+    return entity.get('entityName') or workflow.get('workflowId') or str(index)
+
+
+class SubmissionMonitor:
+    """
+    Tracks the state transitions of every workflow in a submission.
+
+    `transitions[workflow][state]` is how many seconds after submission the workflow was first seen in that
+    state, as observed by polling, so timings are only as precise as the polling interval.
+    """
+
+    def __init__(self, client: TerraClient, submission_id: str, submitted_at: Optional[float] = None):
+        self.client = client
+        self.submission_id = submission_id
+        self.submitted_at = time.time() if submitted_at is None else submitted_at
+        self.transitions: Dict[str, Dict[str, float]] = {}
+        self.states: Dict[str, str] = {}
+        self.polls = 0
+        # the POST /submissions report, whose workflows have only entityName and inputResolutions
+        self.submit_response: Optional[dict] = None
+        self.last_response: Optional[dict] = None
+
+    @classmethod
+    def submit(cls, client: TerraClient, entity: Optional[Tuple[str, str]] = None,
+               expression: Optional[str] = None) -> 'SubmissionMonitor':
+        """
+        Submit md5sum over `entity` (e.g. an entity set) and return a monitor for the submission.
+
+        Workflow states are only observed from the first poll on: the submission report returned here lists
+        each workflow's entity and inputs, but not its status.
+        """
+        submitted_at = time.time()
+        response = client.run_workflow(entity=entity, expression=expression)
+        monitor = cls(client, response['submissionId'], submitted_at)
+        monitor.submit_response = response
+        return monitor
+
+    def observe(self, response: dict):
+        """Record the state of every workflow in a submission status response."""
+        elapsed = time.time() - self.submitted_at
+        self.last_response = response
+        for index, workflow in enumerate(response.get('workflows', [])):
+            if 'status' not in workflow:
+                continue
+            key, state = _workflow_key(index, workflow), workflow['status']
+            if self.states.get(key) != state:
+                self.states[key] = state
+                self.transitions.setdefault(key, {}).setdefault(state, elapsed)
+
+    def poll(self) -> dict:
+        response = self.client.check_workflow_status(self.submission_id)
+        self.polls += 1
+        self.observe(response)
+        return response
+
+    def counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for state in self.states.values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def done(self, response: dict, fail_fast: bool = False) -> bool:
+        if response['status'] in TERMINAL_SUBMISSION_STATES:
+            return True
+        return fail_fast and any(w['status'] == 'Failed' for w in response.get('workflows', []))
+
+    def wait(self,
+             timeout: Optional[float] = None,
+             interval: float = 15,
+             max_interval: float = 60,
+             fail_fast: bool = False) -> dict:
+        """
+        Poll the submission until it is done, returning the final status response.
+
+        :param fail_fast: Stop as soon as any workflow has failed instead of waiting for the rest.
+        :raises polling.PollTimeout: The submission wasn't done after `timeout` seconds.
+        """
+        def state(response: dict) -> Tuple:
+            return response['status'], tuple(sorted(self.counts().items()))
+
+        def log_progress(response: dict):
+            if not self.done(response, fail_fast):
+                log.info('Submission %s is %s: %s', self.submission_id, response['status'], self.counts())
+
+        return polling.wait_for(self.poll,
+                                done=lambda r: self.done(r, fail_fast),
+                                interval=interval,
+                                max_interval=max_interval,
+                                timeout=timeout,
+                                state=state,
+                                on_result=log_progress)
+
+    def latencies(self, states: Iterable[str] = TERMINAL_WORKFLOW_STATES) -> Dict[str, float]:
+        """Seconds from submission until each workflow first reached one of `states`."""
+        states = tuple(states)
+        latencies = {}
+        for key, seen in self.transitions.items():
+            reached = [seen[state] for state in states if state in seen]
+            if reached:
+                latencies[key] = min(reached)
+        return latencies
+
+    def latency_percentiles(self, percentiles: Iterable[float] = (50, 90, 99),
+                            states: Iterable[str] = TERMINAL_WORKFLOW_STATES) -> Dict[float, Optional[float]]:
+        values = list(self.latencies(states).values())
+        return {p: percentile(values, p) for p in percentiles}
+
+    def table(self) -> str:
+        """One line per workflow: its current state and when it was first seen in each state."""
+        lines = []
+        for key, seen in sorted(self.transitions.items()):
+            timeline = ', '.join(f'{state} @ {elapsed:.0f}s' for state, elapsed in sorted(seen.items(), key=lambda kv: kv[1]))
+            lines.append(f'{key}: {self.states[key]} ({timeline})')
+        return '\n'.join(lines)
+
+    def log_summary(self):
+        log.info('Submission %s after %d polls: %s\n%s', self.submission_id, self.polls, self.counts(), self.table())
+        log.info('Workflow latency percentiles (s): %s',
+                 {p: None if v is None else round(v, 1) for p, v in self.latency_percentiles().items()})
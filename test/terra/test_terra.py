@@ -10,8 +10,15 @@ import base64
 import sys
 
 # from test.bq import log_duration, Client
+from .client import TerraClient
+from .submissions import SubmissionMonitor
 from .utilities import Utilities
-from ..bq import log_duration, Client
+from .. import auth, polling, sessions
+from ..metrics import log_metrics
+from ..retry import log_retry_stats
+from ..parallel import ParallelTestRunner, uses_resources
+from ..preflight import Preflight, terra_checks
+from ..bq import log_duration, log_phase_timings, Client, drain, get_client
 from terra_notebook_utils import drs
 
 
@@ -28,8 +35,20 @@ elif STAGE == 'staging':
     RAWLS_DOMAIN = 'https://rawls.dsde-staging.broadinstitute.org'
     ORC_DOMAIN = 'https://firecloud-orchestration.dsde-staging.broadinstitute.org'
     BILLING_PROJECT = 'drs-billing-project'
+elif STAGE == 'local':
+    # see test/stub_server.py
+    GEN3_DOMAIN = RAWLS_DOMAIN = ORC_DOMAIN = os.environ.get('BDCAT_STUB_URL', 'http://127.0.0.1:8900')
+    BILLING_PROJECT = 'stub-billing-project'
 else:
-    raise ValueError('Please set BDCAT_STAGE to "prod" or "staging".')
+    raise ValueError('Please set BDCAT_STAGE to "prod", "staging" or "local".')
+
+terra = TerraClient(rawls_domain=RAWLS_DOMAIN,
+                    orc_domain=ORC_DOMAIN,
+                    billing_project=BILLING_PROJECT,
+                    drs_workspace='DRS-Test-Runner-Workspace' if STAGE == 'prod' else 'DRS-Test-Workspace',
+                    dockstore_workspace='BDC_Dockstore_Import_Tester',
+                    md5sum_namespace='broad-integration-testing' if STAGE == 'prod' else 'drs_tests')
+preflight = Preflight(terra_checks(ORC_DOMAIN, RAWLS_DOMAIN, GEN3_DOMAIN))
 
 logger = logging.getLogger(__name__)
 
@@ -53,18 +72,20 @@ class TestTerra(unittest.TestCase):
         with open(os.path.expanduser('~/.config/gcloud/application_default_credentials.json'), 'w') as f:
             f.write(os.environ['TEST_MULE_CREDS'])
         '''END COMMENT FOR LOCAL TESTING'''
-        print(f'Terra [{STAGE}] Health Status:\n\n{json.dumps(Utilities.check_terra_health(ORC_DOMAIN), indent=4)}')
+        print(f'Preflight [{STAGE}]:\n{preflight.report()}')
 
     @classmethod
     def tearDownClass(cls) -> None:
         try:
-            Utilities.delete_workflow_presence_in_terra_workspace(RAWLS_DOMAIN, BILLING_PROJECT)
+            terra.delete_workflow_presence_in_terra_workspace()
         except:  # noqa
             pass
 
+    @uses_resources('BDC_Dockstore_Import_Tester')
+    @preflight.requires('rawls')
     def test_dockstore_import_in_terra(self):
         # import the workflow into terra
-        response = Utilities.import_dockstore_wf_into_terra(RAWLS_DOMAIN, BILLING_PROJECT)
+        response = terra.import_dockstore_wf_into_terra()
         method_info = response['methodConfiguration']['methodRepoMethod']
         with self.subTest('Dockstore Import Response: sourceRepo'):
             self.assertEqual(method_info['sourceRepo'], 'dockstore')
@@ -75,109 +96,120 @@ class TestTerra(unittest.TestCase):
 
         # check that a second attempt gives a 409 error
         try:
-            Utilities.import_dockstore_wf_into_terra(RAWLS_DOMAIN, BILLING_PROJECT)
+            terra.import_dockstore_wf_into_terra()
         except requests.exceptions.HTTPError as e:
             with self.subTest('Dockstore Import Response: 409 conflict'):
                 self.assertEqual(e.response.status_code, 409)
 
         # check status that the workflow is seen in terra
-        wf_seen_in_terra = Utilities.check_workflow_seen_in_terra(RAWLS_DOMAIN, BILLING_PROJECT)
+        wf_seen_in_terra = terra.check_workflow_seen_in_terra()
         with self.subTest('Dockstore Check Workflow Seen'):
             self.assertTrue(wf_seen_in_terra)
 
         # delete the workflow
-        Utilities.delete_workflow_presence_in_terra_workspace(RAWLS_DOMAIN, BILLING_PROJECT)
+        terra.delete_workflow_presence_in_terra_workspace()
 
         # check status that the workflow is no longer seen in terra
-        wf_seen_in_terra = Utilities.check_workflow_seen_in_terra(RAWLS_DOMAIN, BILLING_PROJECT)
+        wf_seen_in_terra = terra.check_workflow_seen_in_terra()
         with self.subTest('Dockstore Check Workflow Not Seen'):
             self.assertFalse(wf_seen_in_terra)
 
+    @uses_resources('DRS-Test-Workspace')
+    @preflight.requires('rawls', 'gen3')
     def test_drs_workflow_in_terra(self):
-        """This test runs md5sum in a fixed workspace using a drs url from gen3."""
-        response = Utilities.run_workflow(RAWLS_DOMAIN, BILLING_PROJECT, STAGE)
+        """
+        This test runs md5sum in a fixed workspace using a drs url from gen3.
+
+        To check many DRS URIs in one submission, set MD5SUM_TEST_ENTITY_SET to "entityType/entityName" of an
+        entity set in the workspace; one md5sum workflow is run per member.
+        """
+        entity = os.environ.get('MD5SUM_TEST_ENTITY_SET')
+        monitor = SubmissionMonitor.submit(terra, entity=tuple(entity.split('/', 1)) if entity else None)
+        response = monitor.submit_response
         status = response['status']
         with self.subTest('Dockstore Workflow Run Submitted'):
             self.assertEqual(status, 'Submitted')
         with self.subTest('Dockstore Workflow Run Responds with DRS.'):
-            self.assertTrue(response['workflows'][0]['inputResolutions'][0]['value'].startswith('drs://'))
-
-        submission_id = response['submissionId']
+            for workflow in response['workflows']:
+                self.assertTrue(workflow['inputResolutions'][0]['value'].startswith('drs://'))
 
         # md5sum should run for about 4 minutes, but may take far longer(?); give a generous timeout
         # also configurable manually via MD5SUM_TEST_TIMEOUT if held in a pending state
-        start = time.time()
-        deadline = start + int(os.environ.get('MD5SUM_TEST_TIMEOUT', 60 * 60))
+        start = monitor.submitted_at
+        timeout = int(os.environ.get('MD5SUM_TEST_TIMEOUT', 60 * 60))
 
         table = f'unc-renci-bdc-itwg.bdc.terra_md5_latency_min_{STAGE}'
-        while True:
-            response = Utilities.check_workflow_status(rawls_domain=RAWLS_DOMAIN, billing_project=BILLING_PROJECT, submission_id=submission_id)
-            status = response['status']
-            if response['workflows'][0]['status'] == "Failed":
-                log_duration(table, time.time() - start, True)
-                raise RuntimeError(f'The md5sum workflow did not succeed:\n{json.dumps(response, indent=4)}')
-            elif status == 'Done':
-                break
-            else:
-                now = time.time()
-                if now < deadline:
-                    print(f"md5sum workflow state is: {response['workflows'][0]['status']}. "
-                          f"Checking again in 20 seconds.")
-                    time.sleep(20)
-                else:
-                    log_duration(table, time.time() - start)
-                    raise RuntimeError('The md5sum workflow run timed out.  '
-                                       f'Expected 4 minutes, but took longer than '
-                                       f'{float(now - start) / 60.0} minutes.')
+
+        try:
+            response = monitor.wait(timeout=timeout, interval=15, max_interval=60, fail_fast=True)
+        except polling.PollTimeout:
+            log_duration(table, time.time() - start)
+            monitor.log_summary()
+            raise RuntimeError('The md5sum workflow run timed out.  '
+                               f'Expected 4 minutes, but took longer than '
+                               f'{float(time.time() - start) / 60.0} minutes.')
+        monitor.log_summary()
+        if monitor.counts().get('Failed'):
+            log_duration(table, time.time() - start, True)
+            raise RuntimeError(f'The md5sum workflow did not succeed:\n{json.dumps(response, indent=4)}')
         log_duration(table, time.time() - start)
         with self.subTest('Dockstore Workflow Run Completed Successfully'):
-            if response['workflows'][0]['status'] != "Succeeded":
+            if any(workflow['status'] != "Succeeded" for workflow in response['workflows']):
                 raise RuntimeError(f'The md5sum workflow did not succeed:\n{json.dumps(response, indent=4)}')
 
+    @preflight.requires('orchestration', 'rawls')
     def test_pfb_handoff_from_gen3_to_terra(self):
         time_stamp = datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S")
         workspace_name = f'integration_test_pfb_gen3_to_terra_{time_stamp}_delete_me'
         job_id = 0
+        pfb_file = 'https://cdistest-public-test-bucket.s3.amazonaws.com/export_2020-06-02T17_33_36.avro'
+        phases = polling.PhaseTracker()
 
-        with self.subTest('Create a terra workspace.'):
-            response = Utilities.create_terra_workspace(rawls_domain=RAWLS_DOMAIN, billing_project=BILLING_PROJECT, workspace=workspace_name)
+        with self.subTest('Create a terra workspace.'), phases.phase('create_workspace'):
+            response = terra.create_terra_workspace(workspace_name)
             self.assertTrue('workspaceId' in response)
             self.assertTrue(response['createdBy'] == 'biodata.itwg.test.mule@gmail.com')
 
-        with self.subTest('Import static pfb into the terra workspace.'):
-            response = Utilities.import_pfb(workspace=workspace_name,
-                                            pfb_file='https://cdistest-public-test-bucket.s3.amazonaws.com/export_2020-06-02T17_33_36.avro',
-                                            orc_domain=ORC_DOMAIN,
-                                            billing_project=BILLING_PROJECT)
+        with self.subTest('Import static pfb into the terra workspace.'), phases.phase('import_request'):
+            response = terra.import_pfb(workspace=workspace_name, pfb_file=pfb_file)
             job_id = response['jobId']
             self.assertTrue('jobId' in response)
 
         with self.subTest('Check on the import static pfb job status.'):
-            response = Utilities.pfb_job_status_in_terra(workspace=workspace_name, job_id=job_id, orc_domain=ORC_DOMAIN, billing_project=BILLING_PROJECT)
             # this should take < 60 seconds
-            while response['status'] in ['Translating', 'ReadyForUpsert', 'Upserting', 'Pending']:
-                time.sleep(2)
-                response = Utilities.pfb_job_status_in_terra(workspace=workspace_name, job_id=job_id, orc_domain=ORC_DOMAIN, billing_project=BILLING_PROJECT)
+            response = polling.wait_for(lambda: terra.pfb_job_status_in_terra(workspace=workspace_name, job_id=job_id),
+                                        done=polling.state_not_in('Translating', 'ReadyForUpsert', 'Upserting', 'Pending'),
+                                        interval=2,
+                                        max_interval=10,
+                                        state=lambda r: r['status'],
+                                        on_result=phases.on_result)
             self.assertTrue(response['status'] == 'Done',
                             msg=f'Expecting status: "Done" but got "{response["status"]}".\n'
                                 f'Full response: {json.dumps(response, indent=4)}')
 
-        with self.subTest('Delete the terra workspace.'):
-            response = Utilities.delete_terra_workspace(workspace=workspace_name, rawls_domain=RAWLS_DOMAIN, billing_project=BILLING_PROJECT)
+        with self.subTest('Delete the terra workspace.'), phases.phase('delete_workspace'):
+            response = terra.delete_terra_workspace(workspace=workspace_name)
             if not response.ok:
                 raise RuntimeError(
                     f'Could not delete the workspace "{workspace_name}": [{response.status_code}] {response}')
             if response.status_code != 202:
                 logger.critical(f'Response {response.status_code} has changed: {response}')
-            response = Utilities.delete_terra_workspace(workspace=workspace_name, rawls_domain=RAWLS_DOMAIN, billing_project=BILLING_PROJECT)
+            response = terra.delete_terra_workspace(workspace=workspace_name)
             self.assertTrue(response.status_code == 404)
 
+        phases.finish()
+        logger.info('PFB handoff phases: %s', phases.breakdown())
+        log_phase_timings(f'unc-renci-bdc-itwg.bdc.pfb_phase_timing_{STAGE}', workspace_name, phases.durations,
+                          source=pfb_file)
+
+    @preflight.requires('gen3')
     def test_public_data_access(self):
         # this DRS URI only exists on staging and requires os.environ['TERRA_DEPLOYMENT_ENV'] = 'staging'
         if STAGE == "staging":
             drs.head('drs://dg.712C:fa640b0e-9779-452f-99a6-16d833d15bd0',
                      workspace_name='DRS-Test-Workspace', workspace_namespace=BILLING_PROJECT)
 
+    @preflight.requires('gen3')
     def test_controlled_data_access(self):
         # this DRS URI only exists on staging/alpha and requires os.environ['TERRA_DEPLOYMENT_ENV'] = 'staging'
         if STAGE == "staging":
@@ -195,17 +227,18 @@ if __name__ == '__main__':
         test_list['test_public_data_access'] = ''
         test_list['test_controlled_data_access'] = ''
 
-    results = unittest.main(verbosity=2, exit=False)
+    results = unittest.main(verbosity=2, exit=False, testRunner=ParallelTestRunner)
     # if len(results.result.failures) > 0 or len(results.result.errors) > 0:
     #     Utilities.report_out(results.result, WEBHOOK)
     timestamp = datetime.datetime.now()
-    client = Client()
-    all_failures = results.result.errors.extend(results.result.failures)
-    if all_failures is not None:
-        for test, status in all_failures:
-            # Unfortunately this is the only way to get the test method name from the TestCase
-            test_name = test._testMethodName
-            del test_list[test_name]
+    client = get_client()
+    # e.g. tests failed by the preflight because a service is down; these must be logged, not counted as passes
+    all_failures = results.result.errors + results.result.failures
+    if all_failures:
+        # a failed subTest is reported as its own _SubTest; log one row per test method
+        failed_tests = {getattr(test, 'test_case', test)._testMethodName: test for test, status in all_failures}
+        for test_name, test in failed_tests.items():
+            test_list.pop(test_name, None)
             try:
                 # To create tables, skip all tests and set create to True:
                 if STAGE == 'staging':
@@ -213,6 +246,15 @@ if __name__ == '__main__':
                 client.log_test_results(test_name, "failure", timestamp, create=True)
             except Exception as e:
                 logger.exception('Failed to log test %r', test, exc_info=e)
+    for test, reason in results.result.skipped:
+        test_name = test._testMethodName
+        test_list.pop(test_name, None)
+        try:
+            if STAGE == 'staging':
+                test_name = f'staging_{test_name}'
+            client.log_test_results(test_name, "skip", timestamp, create=True)
+        except Exception as e:
+            logger.exception('Failed to log test %r', test, exc_info=e)
     for test_name in test_list.keys():
         try:
             # To create tables, skip all tests and set create to True:
@@ -221,4 +263,9 @@ if __name__ == '__main__':
             client.log_test_results(test_name, "success", timestamp, create=True)
         except Exception as e:
             logger.exception('Failed to log test %r', test, exc_info=e)
+    drain()
+    sessions.log_connection_stats()
+    auth.log_token_stats()
+    log_retry_stats()
+    log_metrics()
     sys.exit(not results.result.wasSuccessful())
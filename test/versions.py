@@ -0,0 +1,207 @@
+"""
+The versions of the BDCat components on every stage, probed concurrently.
+
+Every (stage, component) endpoint is requested at once with a short timeout, so probing all of them takes
+about as long as the slowest single request.  Results are cached for the rest of the run:
+
+    results = version_probe.probe()
+    compatibility(results)['indexd']  # Compatibility(status='ok', ahead='2022.01', behind='2021.12')
+    log.info('\\n%s', format_matrix(results))
+
+Versions are compared as tuples of their leading numbers ('2021.12' -> (2021, 12)), not as strings, so that
+'2021.9' < '2021.10'.  Versions without a leading number (e.g. a commit hash) can only be compared for
+equality.
+"""
+import os
+import re
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from test import sessions
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10.0
+
+STAGE_DOMAINS = {
+    'prod': {'gen3': 'https://gen3.biodatacatalyst.nhlbi.nih.gov',
+             'rawls': 'https://rawls.dsde-prod.broadinstitute.org',
+             'orchestration': 'https://firecloud-orchestration.dsde-prod.broadinstitute.org'},
+    'staging': {'gen3': 'https://staging.gen3.biodatacatalyst.nhlbi.nih.gov',
+                'rawls': 'https://rawls.dsde-alpha.broadinstitute.org',
+                'orchestration': 'https://firecloud-orchestration.dsde-alpha.broadinstitute.org'},
+}
+if os.environ.get('BDCAT_STAGE') == 'local':
+    # see test/stub_server.py
+    _stub_url = os.environ.get('BDCAT_STUB_URL', 'http://127.0.0.1:8900')
+    STAGE_DOMAINS['local'] = {'gen3': _stub_url, 'rawls': _stub_url, 'orchestration': _stub_url}
+
+
+def _version(response: dict) -> Tuple[Optional[str], bool]:
+    return response.get('version'), True
+
+
+def _status(response: dict) -> Tuple[Optional[str], bool]:
+    # Orchestration's /status reports health, not a version
+    return None, bool(response.get('ok'))
+
+
+class Component(NamedTuple):
+    service: str  # a key of STAGE_DOMAINS[stage]
+    path: str
+    extract: Callable[[dict], Tuple[Optional[str], bool]]  # response JSON -> (version, healthy)
+
+
+COMPONENTS = {
+    'indexd': Component('gen3', '/index/_version', _version),
+    'fence': Component('gen3', '/user/_version', _version),
+    'peregrine': Component('gen3', '/peregrine/_version', _version),
+    'rawls': Component('rawls', '/version', _version),
+    'orchestration': Component('orchestration', '/status', _status),
+}
+
+
+def parse_version(version: Optional[str]) -> Optional[Tuple[int, ...]]:
+    """
+    The leading dot-separated numbers of `version`, without trailing zeros, or None if it has none.
+
+    >>> parse_version('2021.12')
+    (2021, 12)
+    >>> parse_version('v4.2.0-rc1')
+    (4, 2)
+    >>> parse_version('d7a3e8b') is None
+    True
+    """
+    match = re.match(r'^[vV]?(\d+(?:\.\d+)*)', version or '')
+    if match is None:
+        return None
+    numbers = [int(n) for n in match.group(1).split('.')]
+    while len(numbers) > 1 and numbers[-1] == 0:
+        numbers.pop()
+    return tuple(numbers)
+
+
+class ComponentVersion(NamedTuple):
+    stage: str
+    component: str
+    version: Optional[str]
+    healthy: bool
+    seconds: float
+    error: Optional[str] = None
+
+    @property
+    def parsed(self) -> Optional[Tuple[int, ...]]:
+        return parse_version(self.version)
+
+
+class VersionProbe:
+    """
+    Fetches component versions concurrently and caches them, per (stage, component), for the life of the
+    process.
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, stage_domains: Dict[str, Dict[str, str]] = STAGE_DOMAINS):
+        self.timeout = timeout
+        self.stage_domains = stage_domains
+        self._results: Dict[Tuple[str, str], ComponentVersion] = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, stage: str, name: str) -> ComponentVersion:
+        component = COMPONENTS[name]
+        url = self.stage_domains[stage][component.service] + component.path
+        start = time.perf_counter()
+        try:
+            response = sessions.get(url, headers={'Accept': 'application/json'}, timeout=self.timeout)
+            response.raise_for_status()
+            version, healthy = component.extract(response.json())
+        except Exception as e:
+            log.warning('Failed to get the %s version on %s from %s: %s', name, stage, url, e)
+            return ComponentVersion(stage, name, None, False, time.perf_counter() - start, f'{type(e).__name__}: {e}')
+        return ComponentVersion(stage, name, version, healthy, time.perf_counter() - start)
+
+    def probe(self,
+              stages: Optional[Iterable[str]] = None,
+              components: Iterable[str] = COMPONENTS,
+              refresh: bool = False) -> List[ComponentVersion]:
+        """
+        The version of each of `components` on each of `stages` (all configured stages by default).
+
+        :param refresh: Fetch again even what has already been fetched in this run.
+        """
+        keys = [(stage, name) for stage in (stages or self.stage_domains) for name in components]
+        with self._lock:
+            missing = [key for key in keys if refresh or key not in self._results]
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='version-probe') as executor:
+                fetched = list(executor.map(lambda key: self._fetch(*key), missing))
+            with self._lock:
+                for result in fetched:
+                    self._results[(result.stage, result.component)] = result
+        with self._lock:
+            return [self._results[key] for key in keys]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+version_probe = VersionProbe()
+
+
+class Compatibility(NamedTuple):
+    """
+    How a component's version on the `ahead` stage compares with the `behind` stage:
+
+    'ok': ahead is on the same or a newer version, 'older': it is on an older one, 'differs': the versions
+    aren't comparable and not equal, 'unknown': a version couldn't be fetched.  Components that report only
+    their health (Orchestration) are 'healthy' or 'unhealthy'.
+    """
+    status: str
+    ahead: Optional[str]
+    behind: Optional[str]
+
+
+def compatibility(results: Iterable[ComponentVersion],
+                  ahead: str = 'staging',
+                  behind: str = 'prod') -> Dict[str, Compatibility]:
+    """Per component, whether stage `ahead` is on the same or a newer version than stage `behind`."""
+    by_key = {(result.stage, result.component): result for result in results}
+    matrix = {}
+    for name in dict.fromkeys(component for _, component in by_key):
+        new, old = by_key.get((ahead, name)), by_key.get((behind, name))
+        new_version = new.version if new else None
+        old_version = old.version if old else None
+        if new and old and not (new.error or old.error) and new_version is None and old_version is None:
+            status = 'healthy' if new.healthy and old.healthy else 'unhealthy'
+        elif new_version is None or old_version is None:
+            status = 'unknown'
+        elif new.parsed is not None and old.parsed is not None:
+            status = 'ok' if new.parsed >= old.parsed else 'older'
+        else:
+            status = 'ok' if new_version == old_version else 'differs'
+        matrix[name] = Compatibility(status, new_version, old_version)
+    return matrix
+
+
+def format_matrix(results: Iterable[ComponentVersion], ahead: str = 'staging', behind: str = 'prod') -> str:
+    """A table of components by stage, with the `ahead`/`behind` compatibility of each component."""
+    results = list(results)
+    stages = list(dict.fromkeys(result.stage for result in results))
+    cells = {(result.stage, result.component): result for result in results}
+
+    def cell(result: Optional[ComponentVersion]) -> str:
+        if result is None:
+            return '-'
+        if result.error:
+            return 'error'
+        return result.version or ('healthy' if result.healthy else 'unhealthy')
+
+    rows = [['component'] + stages + [f'{ahead} vs {behind}']]
+    for name, compat in compatibility(results, ahead, behind).items():
+        rows.append([name] + [cell(cells.get((stage, name))) for stage in stages] + [compat.status])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)